@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+import time
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+
+
+def percentile(sorted_samples, q):
+    if not sorted_samples:
+        return 0.0
+    index = min(int(len(sorted_samples) * q), len(sorted_samples) - 1)
+    return sorted_samples[index]
+
+
+async def run_load(operation, requests, concurrency):
+    """
+    Call `operation(i)` `requests` times with at most `concurrency` in flight.
+    Returns a summary with throughput and latency percentiles in ms.
+    """
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                await operation(i)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50": round(percentile(latencies, 0.50), 3),
+        "p90": round(percentile(latencies, 0.90), 3),
+        "p99": round(percentile(latencies, 0.99), 3),
+        "max": round(latencies[-1], 3) if latencies else 0.0,
+    }
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def load_baseline(name):
+    path = baseline_path(name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(name, results):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    with open(baseline_path(name), "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def _delta(current, previous, lower_is_better=True):
+    if not previous:
+        return ""
+    change = (current - previous) / previous * 100
+    worse = change > 0 if lower_is_better else change < 0
+    return f" ({change:+.0f}%{' !' if worse and abs(change) > 10 else ''})"
+
+
+def print_report(results, baseline=None):
+    baseline = baseline or {}
+    print(f"{'scenario':16}{'req/s':>18}{'p50 ms':>18}{'p90 ms':>18}{'p99 ms':>18}{'errors':>8}")
+    for name, r in results.items():
+        b = baseline.get(name, {})
+        print(f"{name:16}"
+              f"{str(r['throughput']) + _delta(r['throughput'], b.get('throughput'), False):>18}"
+              f"{str(r['p50']) + _delta(r['p50'], b.get('p50')):>18}"
+              f"{str(r['p90']) + _delta(r['p90'], b.get('p90')):>18}"
+              f"{str(r['p99']) + _delta(r['p99'], b.get('p99')):>18}"
+              f"{r['errors']:>8}")
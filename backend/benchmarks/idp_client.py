@@ -0,0 +1,136 @@
+"""
+The outbound IdP client against devtools.stub_idp on a real socket:
+keep-alive reuse, retries, timeouts, the circuit breaker and the
+concurrency cap. Exits non-zero if any check fails.
+
+    python -m benchmarks.idp_client --calls 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from devtools.stub_idp import StubIdP
+
+SETTINGS = {
+    "IDP_READ_TIMEOUT": "0.3",
+    "IDP_RETRIES": "2",
+    "IDP_RETRY_BASE_DELAY": "0.01",
+    "IDP_BREAKER_THRESHOLD": "5",
+    "IDP_BREAKER_COOLDOWN": "0.5",
+    "IDP_MAX_CONCURRENCY": "8",
+}
+
+
+async def timed(call):
+    start = time.perf_counter()
+    try:
+        result = await call
+    except Exception as e:
+        result = e
+    return result, time.perf_counter() - start
+
+
+async def checks(stub, calls):
+    import httpx
+
+    from core import idp
+
+    results = {}
+    await idp.start()
+    try:
+        # keep-alive: sequential calls share one connection
+        start = time.perf_counter()
+        for _ in range(calls):
+            await idp.refresh_tokens("stub")
+        pooled = (time.perf_counter() - start) / calls * 1000
+        results["one connection for sequential calls"] = len(stub.connections) == 1
+
+        start = time.perf_counter()
+        for _ in range(calls):
+            async with httpx.AsyncClient() as client:
+                await client.post(f"{stub.url}/oauth/token", data={"grant_type": "refresh_token"})
+        fresh = (time.perf_counter() - start) / calls * 1000
+        print(f"  per call: {pooled:.2f} ms pooled, {fresh:.2f} ms with a new connection each")
+
+        stub.reset()
+        stub.script(503, 429)
+        res, _ = await timed(idp.refresh_tokens("stub"))
+        results["transient 503/429 retried"] = getattr(res, "status_code", None) == 200 and stub.calls == 3
+
+        # the provider may have processed a POST that got a 502
+        stub.reset()
+        stub.script(502)
+        res, _ = await timed(idp.refresh_tokens("stub"))
+        results["POST not retried after 502"] = getattr(res, "status_code", None) == 503 and stub.calls == 1
+
+        stub.reset()
+        stub.script(502)
+        res = await asyncio.to_thread(idp.request_sync, "GET", idp.config.IDP_JWKS_URL)
+        results["GET retried after 502"] = res.status_code == 200 and stub.calls == 2
+
+        stub.reset()
+        stub.script(400)
+        res, _ = await timed(idp.exchange_code("stub"))
+        results["refused code is a 400"] = getattr(res, "status_code", None) == 400
+
+        stub.reset()
+        stub.delay = 2.0
+        res, elapsed = await timed(idp.refresh_tokens("stub"))
+        print(f"  slow provider: gave up after {elapsed:.2f}s with {getattr(res, 'status_code', res)}")
+        results["slow provider times out"] = getattr(res, "status_code", None) == 503 and elapsed < 2.0
+
+        await asyncio.to_thread(stub.wait_idle)
+        stub.reset()
+        idp.breaker.success()
+        stub.script(*[503] * 100)
+        while idp.breaker.state == "closed":
+            await timed(idp.refresh_tokens("stub"))
+        before = stub.calls
+        res, elapsed = await timed(idp.refresh_tokens("stub"))
+        print(f"  circuit open: failed in {elapsed * 1000:.2f} ms")
+        results["open circuit fails fast"] = stub.calls == before and elapsed < 0.01
+
+        stub.script()
+        await asyncio.sleep(float(os.environ["IDP_BREAKER_COOLDOWN"]))
+        res, _ = await timed(idp.refresh_tokens("stub"))
+        results["circuit closes after a good trial call"] = (
+            getattr(res, "status_code", None) == 200 and idp.breaker.state == "closed")
+
+        stub.reset()
+        stub.delay = 0.05
+        await asyncio.gather(*(timed(idp.refresh_tokens("stub")) for _ in range(50)))
+        print(f"  50 concurrent calls, at most {stub.max_inflight} in flight at the provider")
+        results["concurrency capped"] = stub.max_inflight <= int(os.environ["IDP_MAX_CONCURRENCY"])
+
+        stub.reset()
+        res = await asyncio.to_thread(idp.request_sync, "GET", idp.config.IDP_JWKS_URL)
+        results["sync client (jwks)"] = res.status_code == 200
+    finally:
+        await idp.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    with StubIdP() as stub:
+        # read by core.config on import
+        os.environ["IDP_BASE_URL"] = stub.url
+        for name, value in SETTINGS.items():
+            os.environ.setdefault(name, value)
+        os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+        results = asyncio.run(checks(stub, args.calls))
+
+    for name, ok in results.items():
+        print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+    sys.exit(0 if all(results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Concurrency stress test for MAX_N: every user logs in from more devices
+than allowed, all at once, from several worker processes sharing one
+database. Exits non-zero if any user ends up with more than MAX_N active
+devices.
+
+    python -m benchmarks.max_devices --users 50 --devices 6 --workers 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs, urlparse
+
+from .run import configure
+
+
+async def _logins(worker, users, devices, barrier):
+    import httpx
+
+    import main
+    from core import idp
+    from devtools import fake_idp as fake_idp_app
+
+    fake_idp = fake_idp_app.idp
+    idp._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_idp_app.app),
+                                    base_url=os.environ["IDP_BASE_URL"])
+    outcomes = {"admitted": 0, "rejected": 0, "errors": 0}
+    # sign up front so the logins actually overlap instead of queueing behind RS256
+    codes = {(user, device): fake_idp.issue_code(f"user{user}@example.com", presign=True)
+             for user in range(users) for device in range(devices)}
+
+    async with main.lifespan(main.app):
+        async def login(user, device):
+            # request.client.host is the device ip the app sees
+            transport = httpx.ASGITransport(app=main.app,
+                                            client=(f"10.{worker}.{user % 256}.{device}", 50000))
+            async with httpx.AsyncClient(transport=transport, base_url="http://backend.local") as client:
+                r = await client.get("/token", params={"code": codes[user, device]})
+                login_id = parse_qs(urlparse(r.headers["location"]).query)["login_id"][0]
+                r = await client.post("/session/check", json={
+                    "login_id": login_id, "device_name": f"device{device}", "device_info": "stress"})
+            if r.status_code == 200:
+                outcomes["admitted"] += 1
+            elif r.status_code == 403:
+                outcomes["rejected"] += 1
+            else:
+                outcomes["errors"] += 1
+
+        # all workers start the burst together
+        await asyncio.to_thread(barrier.wait)
+        await asyncio.gather(*(login(user, device)
+                               for user in range(users) for device in range(devices)))
+    return outcomes
+
+
+def worker(index, users, devices, barrier, results):
+    results.put(asyncio.run(_logins(index, users, devices, barrier)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--devices", type=int, default=6, help="devices per user per worker")
+    parser.add_argument("--workers", type=int, default=4, help="processes sharing the database")
+    parser.add_argument("--max-n", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["MAX_N"] = str(args.max_n)
+        configure(tmp)
+
+        from sqlalchemy import func, select
+
+        from core.database.database import engine
+        from core.database.migrations import upgrade
+        from core.database.models import UserSession
+
+        upgrade(engine)
+
+        # spawn: each worker imports its own app, engine and pending-login store
+        ctx = multiprocessing.get_context("spawn")
+        barrier = ctx.Barrier(args.workers + 1)
+        queue = ctx.Queue()
+        processes = [ctx.Process(target=worker, args=(i, args.users, args.devices, barrier, queue))
+                     for i in range(args.workers)]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        start = time.perf_counter()
+        results = [queue.get() for _ in processes]
+        elapsed = time.perf_counter() - start
+        for process in processes:
+            process.join()
+
+        totals = {key: sum(r[key] for r in results) for key in results[0]}
+        with engine.connect() as conn:
+            devices = func.count(func.distinct(UserSession.device_ip))
+            over = conn.execute(
+                select(UserSession.user_email, devices)
+                .where(UserSession.is_active == True)
+                .group_by(UserSession.user_email)
+                .having(devices > args.max_n)
+            ).all()
+        engine.dispose()
+
+    attempts = args.users * args.devices * args.workers
+    print(f"{attempts} logins in {elapsed:.1f}s: {totals['admitted']} admitted, "
+          f"{totals['rejected']} rejected, {totals['errors']} errors")
+    expected = args.users * min(args.max_n, args.devices * args.workers)
+    print(f"expected {expected} admitted, users over MAX_N={args.max_n}: {len(over)}")
+    for email, count in over[:10]:
+        print(f"  {email}: {count} devices")
+    sys.exit(1 if over or totals["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
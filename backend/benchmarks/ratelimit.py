@@ -0,0 +1,110 @@
+"""
+Rate limiter overhead: cost of one admission decision and memory per key,
+then a burst from one client against the app to show the 429s.
+
+    python -m benchmarks.ratelimit --keys 100000 --hits 1000000
+    python -m benchmarks.ratelimit --database
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from .run import configure
+
+
+def per_hit(limiter, keys, hits):
+    start = time.perf_counter()
+    for i in range(hits):
+        limiter.hit(keys[i % len(keys)])
+    return (time.perf_counter() - start) / hits * 1e6
+
+
+def per_enforce(limiter, keys, hits):
+    from core.ratelimit import enforce
+
+    async def loop():
+        start = time.perf_counter()
+        for i in range(hits):
+            await enforce(limiter, keys[i % len(keys)])
+        return (time.perf_counter() - start) / hits * 1e6
+    return asyncio.run(loop())
+
+
+def bytes_per_key(limiter_cls, keys):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    limiter = limiter_cls("bench", 1.0, 10, max_keys=len(keys))
+    for key in keys:
+        limiter.hit(key)
+    used = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(before, "filename"))
+    tracemalloc.stop()
+    return used / len(keys)
+
+
+async def burst(requests):
+    import httpx
+
+    import main
+
+    transport = httpx.ASGITransport(app=main.app, client=("198.51.100.7", 50000))
+    statuses = {}
+    retry_after = None
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend.local") as client:
+            for _ in range(requests):
+                r = await client.post("/logout/force", json={
+                    "logout_device_ip": "198.51.100.8", "device_name": "bench", "device_info": "ratelimit"})
+                statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+                if r.status_code == 429:
+                    retry_after = r.headers["retry-after"]
+    return statuses, retry_after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=100_000, help="distinct client ips")
+    parser.add_argument("--hits", type=int, default=1_000_000)
+    parser.add_argument("--database", action="store_true", help="also time the shared database backend")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["RATE_LIMIT_IP_RATE"] = "1"
+        os.environ["RATE_LIMIT_IP_BURST"] = "10"
+        configure(tmp)
+
+        from core.database.database import engine
+        from core.database.migrations import upgrade
+        from core.ratelimit import DatabaseRateLimiter, MemoryRateLimiter
+
+        upgrade(engine)
+        keys = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(args.keys)]
+
+        print(f"{'case':<40}{'us/hit':>10}")
+        rows = [
+            ("memory, distinct keys", per_hit(MemoryRateLimiter("b", 1.0, 10, max_keys=args.keys), keys, args.hits)),
+            ("memory, one key (limited)", per_hit(MemoryRateLimiter("b", 1.0, 10), keys[:1], args.hits)),
+            ("memory, evicting (max_keys=keys/10)",
+             per_hit(MemoryRateLimiter("b", 1.0, 10, max_keys=max(args.keys // 10, 1)), keys, args.hits)),
+            ("memory, via enforce() (async)",
+             per_enforce(MemoryRateLimiter("b", 1000.0, 1000, max_keys=args.keys), keys, args.hits // 10)),
+        ]
+        if args.database:
+            rows.append(("database", per_hit(DatabaseRateLimiter("b", 1.0, 10), keys, min(args.hits, 2000))))
+        for name, us in rows:
+            print(f"{name:<40}{us:>10.2f}")
+        print(f"\nmemory per key: {bytes_per_key(MemoryRateLimiter, keys):.0f} bytes")
+
+        statuses, retry_after = asyncio.run(burst(30))
+        print(f"30 force logouts from one ip (burst 10, 1/s): {statuses}, Retry-After {retry_after}")
+        engine.dispose()
+
+    sys.exit(0 if statuses.get(429) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Load scenarios against the real app, in-process, with the fake identity
+provider standing in for Auth0. Nothing leaves the machine.
+
+    python -m benchmarks.run --rows 100000 --requests 2000 --concurrency 32
+    python -m benchmarks.run --save-baseline main
+    python -m benchmarks.run --baseline main
+
+Scenarios:
+- login: /token -> /session/check for a fresh user
+- validate: /session/validate polling with a seeded session cookie
+  (a signed token with SESSION_TOKEN_MODE=signed)
+- protected: /protected with a bearer token
+- force_logout: /logout/force storms against seeded device ips
+
+Results are compared against benchmarks/baselines/<name>.json when it exists.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+from urllib.parse import parse_qs, urlparse
+
+from .harness import load_baseline, print_report, run_load, save_baseline
+
+SCENARIOS = ["login", "validate", "protected", "force_logout"]
+
+
+def configure(tmp):
+    """Point the app at a throwaway database and the fake IdP before it is imported."""
+    os.environ.setdefault("DOMAIN", "fake-idp.local")
+    os.environ.setdefault("API_AUDIENCE", "https://n-auth.local/api")
+    os.environ.setdefault("CLIENT_ID", "benchmark")
+    os.environ.setdefault("CLIENT_SECRET", "benchmark")
+    os.environ.setdefault("FRONTEND_URI", "http://frontend.local")
+    os.environ.setdefault("BACKEND_URI", "http://backend.local")
+    os.environ.setdefault("MAX_N", "3")
+    os.environ.setdefault("IDP_BASE_URL", "http://fake-idp.local")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # all load comes from one client, measure the app rather than the limiter
+    os.environ.setdefault("RATE_LIMIT_IP_RATE", "0")
+    os.environ.setdefault("RATE_LIMIT_USER_RATE", "0")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.sqlite3')}"
+    # read by core.auth on import, written once the fake IdP has its keys
+    os.environ["JWKS_FILE"] = os.path.join(tmp, "jwks.json")
+
+    from devtools.fake_idp import idp as fake_idp
+
+    with open(os.environ["JWKS_FILE"], "w") as f:
+        json.dump(fake_idp.jwks(), f)
+    return fake_idp
+
+
+def session_cookies(active_ids):
+    """Cookie values /session/check would have set for the seeded sessions."""
+    from sqlalchemy import select
+
+    from core.auth import session_tokens
+    from core.database.database import SessionLocal
+    from core.database.models import UserSession
+
+    if session_tokens is None:
+        return active_ids
+    with SessionLocal() as db:
+        rows = db.execute(select(UserSession.session_id, UserSession.user_id, UserSession.expires_at)
+                          .where(UserSession.is_active == True)).all()
+    return [session_tokens.issue(*row) for row in rows]
+
+
+async def run_scenarios(args, fake_idp, active_ids, ips):
+    import httpx
+
+    import main
+    from core import idp
+    from devtools import fake_idp as fake_idp_app
+
+    # outbound IdP calls go straight to the fake app
+    idp._client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=fake_idp_app.app),
+        base_url=os.environ["IDP_BASE_URL"],
+    )
+    rng = random.Random(args.seed)
+    cookies = session_cookies(active_ids)
+    tokens = [fake_idp.access_token(f"fake|bench{i}") for i in range(64)]
+    # RS256 signing in the fake IdP is slow and shares the event loop, keep it out of the timings
+    codes = []
+    if "login" in args.scenarios:
+        codes = [fake_idp.issue_code(f"bench{i}@example.com", presign=True)
+                 for i in range(args.requests)]
+    results = {}
+
+    async with main.lifespan(main.app):
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app),
+                                   base_url="http://backend.local")
+
+        async def login(i):
+            r = await client.get("/token", params={"code": codes[i]})
+            login_id = parse_qs(urlparse(r.headers["location"]).query)["login_id"][0]
+            r = await client.post("/session/check", json={
+                "login_id": login_id, "device_name": "bench", "device_info": "benchmark"})
+            r.raise_for_status()
+
+        async def validate(i):
+            cookie = cookies[rng.randrange(len(cookies))]
+            r = await client.get("/session/validate", headers={"Cookie": f"session_id={cookie}"})
+            r.raise_for_status()
+
+        async def protected(i):
+            r = await client.get("/protected",
+                                 headers={"Authorization": f"Bearer {tokens[i % len(tokens)]}"})
+            r.raise_for_status()
+
+        async def force_logout(i):
+            r = await client.post("/logout/force", json={
+                "logout_device_ip": ips[rng.randrange(len(ips))],
+                "device_name": "bench", "device_info": "benchmark"})
+            if r.status_code >= 500:
+                r.raise_for_status()
+
+        operations = {"login": login, "validate": validate,
+                      "protected": protected, "force_logout": force_logout}
+        for name in args.scenarios:
+            results[name] = await run_load(operations[name], args.requests, args.concurrency)
+        await client.aclose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000, help="seeded user_sessions rows")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--baseline", default="default", help="baseline to compare against")
+    parser.add_argument("--save-baseline", metavar="NAME", help="store these results as a baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fake_idp = configure(tmp)
+
+        from core.database.database import engine
+        from core.database.migrations import upgrade
+        from .seed import device_ip, seed
+
+        upgrade(engine)
+        users = max(args.rows // 10, 1)
+        _, active_ids = seed(engine, args.rows, users, seed=args.seed)
+        if not active_ids:
+            parser.error("--rows too small, no active sessions were seeded")
+        ips = [device_ip(user, 0) for user in range(min(users, 1000))]
+        print(f"Seeded {args.rows} sessions ({len(active_ids)} active)")
+
+        results = asyncio.run(run_scenarios(args, fake_idp, active_ids, ips))
+
+    print_report(results, load_baseline(args.baseline))
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+        print(f"Saved baseline '{args.save_baseline}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Synthetic user_sessions data, 10^3 to 10^7 rows, generated lazily and
+inserted in executemany batches so memory stays flat.
+
+    python -m benchmarks.seed --rows 1000000 --db /tmp/bench.sqlite3
+"""
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from itertools import islice
+
+from sqlalchemy import create_engine, insert
+
+from core.database.migrations import upgrade
+from core.database.models import UserSession
+
+DEVICE_NAMES = ["Chrome", "Firefox", "Safari", "Edge"]
+
+
+def user_email(user):
+    return f"user{user}@example.com"
+
+
+def device_ip(user, device):
+    return f"10.{user % 256}.{(user // 256) % 256}.{device}"
+
+
+def generate_sessions(rows, users, active_ratio=0.05, devices_per_user=4, seed=42, now=None):
+    """Yield session rows; about `active_ratio` of them are active and unexpired."""
+    rng = random.Random(seed)
+    now = now or datetime.utcnow()
+    for _ in range(rows):
+        user = rng.randrange(users)
+        device = rng.randrange(devices_per_user)
+        created = now - timedelta(days=rng.randrange(365), seconds=rng.randrange(86400))
+        active = rng.random() < active_ratio
+        yield {
+            "session_id": str(uuid.uuid4()),
+            "user_id": f"auth0|{user}",
+            "user_email": user_email(user),
+            "device_ip": device_ip(user, device),
+            "device_name": DEVICE_NAMES[device % len(DEVICE_NAMES)],
+            "device_info": "benchmark",
+            "created_at": created,
+            "last_active": created,
+            "expires_at": now + timedelta(days=15) if active else created + timedelta(days=30),
+            "is_active": active,
+            "closed_at": None if active else created + timedelta(days=1),
+            "closed_reason": None if active else "user_logout",
+        }
+
+
+def insert_sessions(engine, sessions, chunk=50000):
+    """Insert rows from any iterable in chunks; returns active session ids."""
+    table = UserSession.__table__
+    active_ids = []
+    total = 0
+    sessions = iter(sessions)
+    while True:
+        batch = list(islice(sessions, chunk))
+        if not batch:
+            break
+        with engine.begin() as conn:
+            conn.execute(insert(table), batch)
+        active_ids.extend(row["session_id"] for row in batch if row["is_active"])
+        total += len(batch)
+    return total, active_ids
+
+
+def seed(engine, rows, users=None, active_ratio=0.05, seed=42):
+    users = users or max(rows // 10, 1)
+    return insert_sessions(engine, generate_sessions(rows, users, active_ratio, seed=seed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=None)
+    parser.add_argument("--active-ratio", type=float, default=0.05)
+    parser.add_argument("--db", required=True, help="sqlite file to create or extend")
+    args = parser.parse_args()
+
+    engine = create_engine(f"sqlite:///{args.db}")
+    upgrade(engine)
+    start = time.perf_counter()
+    total, active_ids = seed(engine, args.rows, args.users, args.active_ratio)
+    print(f"Inserted {total} sessions ({len(active_ids)} active) "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Query plans and latencies of the hot session lookups before and after the
+user_sessions indexes.
+
+    python -m benchmarks.session_indexes --rows 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine, select, text
+
+from core.auth import admission_condition, login_snapshot_query
+from core.database.database import Base
+from core.database.migrations import upgrade
+from core.database.models import UserSession
+
+from .seed import DEVICE_NAMES, device_ip, generate_sessions, insert_sessions, user_email
+
+NOW = datetime.utcnow()
+
+
+def hot_queries(email, ip):
+    """The statements the app runs, built by the same functions."""
+    return {
+        # /session/check, then the admission INSERT ... SELECT
+        "login_snapshot": login_snapshot_query(email, NOW, ip, DEVICE_NAMES[0], "benchmark"),
+        "admission_check": select(admission_condition(email, ip, 3, NOW)),
+        # bulk_forced_logout's UPDATE, as a select of the same rows
+        "force_logout_lookup": (
+            select(UserSession.session_id)
+            .where(UserSession.is_active == True, UserSession.device_ip.in_([ip]))
+        ),
+    }
+
+
+def explain(conn, stmt):
+    compiled = stmt.compile(conn, compile_kwargs={"literal_binds": True})
+    rows = conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+    return "; ".join(row[-1] for row in rows)
+
+
+def measure(engine, users, iterations):
+    rng = random.Random(7)
+    results = {}
+    with engine.connect() as conn:
+        for name, stmt in hot_queries(user_email(1), device_ip(1, 0)).items():
+            results[name] = {"plan": explain(conn, stmt), "samples": []}
+
+        for _ in range(iterations):
+            user = rng.randrange(users)
+            ip = device_ip(user, rng.randrange(4))
+            for name, stmt in hot_queries(user_email(user), ip).items():
+                start = time.perf_counter()
+                conn.execute(stmt).all()
+                results[name]["samples"].append((time.perf_counter() - start) * 1000)
+    return results
+
+
+def report(label, results):
+    print(f"\n== {label}")
+    for name, result in results.items():
+        samples = sorted(result["samples"])
+        p99 = samples[int(len(samples) * 0.99) - 1]
+        print(f"{name:22} mean {statistics.mean(samples):8.3f} ms  p99 {p99:8.3f} ms")
+        print(f"{'':22} plan: {result['plan']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.sqlite3')}")
+        Base.metadata.create_all(bind=engine)
+        with engine.begin() as conn:
+            for index in UserSession.__table__.indexes:
+                conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+
+        start = time.perf_counter()
+        insert_sessions(engine, generate_sessions(args.rows, args.users, now=NOW))
+        print(f"Seeded {args.rows} rows in {time.perf_counter() - start:.1f}s")
+
+        report("before", measure(engine, args.users, args.iterations))
+
+        start = time.perf_counter()
+        created = upgrade(engine)
+        print(f"\nupgrade() created {created} in {time.perf_counter() - start:.1f}s")
+
+        report("after", measure(engine, args.users, args.iterations))
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
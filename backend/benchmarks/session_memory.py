@@ -0,0 +1,106 @@
+"""
+Bytes per cached session: UserSession ORM instances, the old state dicts
+and SessionRecord, the last one also inside a full SessionCache.
+No database needed; sessions are generated in memory. tracemalloc makes
+the 10^6 run take several minutes.
+
+    python -m benchmarks.session_memory --sessions 1000000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+from .seed import generate_sessions
+
+
+def measure(build, count):
+    """Bytes per session still allocated by build(count)'s result."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = build(count)
+    gc.collect()
+    used = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(before, "filename"))
+    tracemalloc.stop()
+    del kept
+    return used / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=1_000_000)
+    parser.add_argument("--orm-sample", type=int, default=20_000,
+                        help="ORM instances and dicts are measured on a sample, they don't fit 10^6")
+    args = parser.parse_args()
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    from core.database.models import UserSession
+    from core.revocation import revocation
+    from core.session_cache import InvalidationChannel, SessionCache, SessionRecord
+
+    users = max(args.sessions // 3, 1)
+
+    def sessions(count, orm=True):
+        # as loaded for validation: active, with tokens; SimpleNamespace when only
+        # the converted result is kept, building 10^6 ORM instances takes minutes
+        make = UserSession if orm else SimpleNamespace
+        for row in generate_sessions(count, min(users, count), active_ratio=1.0):
+            row.update(access_token="x" * 900, refresh_token="y" * 40,
+                       access_token_exp=int(time.time()) + 3600, force_logged_by=None,
+                       force_logged_at=None, force_logout_message=None)
+            yield make(**row)
+
+    def state_dict(session):
+        return {
+            "session_id": session.session_id,
+            "user_id": session.user_id,
+            "user_email": session.user_email,
+            "is_active": session.is_active,
+            "expires_at": session.expires_at,
+            "closed_reason": session.closed_reason,
+            "force_logged_by": session.force_logged_by,
+            "force_logged_at": session.force_logged_at,
+            "force_logout_message": session.force_logout_message,
+            "access_token_exp": session.access_token_exp,
+        }
+
+    def in_cache(count):
+        cache = SessionCache(InvalidationChannel(), maxsize=count, ttl=3600)
+        for session in sessions(count, orm=False):
+            cache.put(session.session_id, SessionRecord.from_session(session))
+        return cache
+
+    sample = min(args.orm_sample, args.sessions)
+    rows = [
+        ("UserSession (ORM instance)", sample, lambda n: list(sessions(n))),
+        ("state dict (before)", sample, lambda n: [state_dict(s) for s in sessions(n)]),
+        ("SessionRecord", args.sessions, lambda n: [SessionRecord.from_session(s) for s in sessions(n, orm=False)]),
+        ("SessionRecord in SessionCache", args.sessions, in_cache),
+    ]
+    print(f"{'representation':<32}{'sessions':>10}{'bytes/session':>15}{'MB at 10^6':>12}")
+    for name, count, build in rows:
+        per = measure(build, count)
+        print(f"{name:<32}{count:>10}{per:>15.0f}{per * 1e6 / 2 ** 20:>12.0f}")
+
+    # the read path: the old check on a dict of datetimes vs revocation() on a record
+    session = next(sessions(1))
+    record, state = SessionRecord.from_session(session), state_dict(session)
+    checks = (
+        ("state dict", lambda: state["is_active"] and state["expires_at"] > datetime.utcnow()),
+        ("SessionRecord", lambda: revocation(record, time.time())),
+    )
+    for name, check in checks:
+        start = time.perf_counter()
+        for _ in range(200_000):
+            check()
+        print(f"validation check on {name}: {(time.perf_counter() - start) / 200_000 * 1e9:.0f} ns")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Validate / login throughput of the default vs tuned SQLite profile under
+concurrent load.
+
+    python -m benchmarks.sqlite_profiles --threads 16 --seconds 10
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, update
+from sqlalchemy.orm import sessionmaker
+
+from core.auth import get_login_snapshot
+from core.config import Config
+from core.database.database import Base
+from core.database.models import UserSession
+from core.database.sqlite import create_sqlite_engine
+
+
+def profile_config(profile):
+    return type(f"{profile.title()}Config", (Config,), {"SQLITE_PROFILE": profile})()
+
+
+def seed(engine, sessions, users):
+    now = datetime.utcnow()
+    rows = []
+    for i in range(sessions):
+        user = i % users
+        rows.append({
+            "session_id": str(uuid.uuid4()),
+            "user_id": f"auth0|{user}",
+            "user_email": f"user{user}@example.com",
+            "device_ip": f"10.0.{user % 256}.{i % 4}",
+            "device_name": "Chrome",
+            "device_info": "bench",
+            "created_at": now,
+            "last_active": now,
+            "expires_at": now + timedelta(days=30),
+            "is_active": True,
+        })
+    with engine.begin() as conn:
+        conn.execute(insert(UserSession.__table__), rows)
+    return [row["session_id"] for row in rows]
+
+
+def validate_op(Session, session_ids, rng):
+    session_id = rng.choice(session_ids)
+    with Session() as db:
+        db.get(UserSession, session_id)
+        # roughly what the batched last_active writer adds
+        if rng.random() < 0.1:
+            db.execute(update(UserSession)
+                       .where(UserSession.session_id == session_id)
+                       .values(last_active=datetime.utcnow()))
+            db.commit()
+
+
+def login_op(Session, users, rng):
+    user = rng.randrange(users)
+    now = datetime.utcnow()
+    with Session() as db:
+        get_login_snapshot(db, f"user{user}@example.com", "10.9.9.9", "Firefox", "bench")
+        db.add(UserSession(
+            session_id=str(uuid.uuid4()), user_id=f"auth0|{user}",
+            user_email=f"user{user}@example.com", device_ip="10.9.9.9",
+            device_name="Firefox", device_info="bench", created_at=now,
+            last_active=now, expires_at=now + timedelta(days=30), is_active=True,
+        ))
+        db.commit()
+
+
+def run(profile, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_sqlite_engine(f"sqlite:///{os.path.join(tmp, 'bench.sqlite3')}",
+                                      profile_config(profile))
+        Base.metadata.create_all(bind=engine)
+        session_ids = seed(engine, args.sessions, args.users)
+        Session = sessionmaker(bind=engine, autoflush=False)
+
+        latencies = {"validate": [], "login": []}
+        errors = [0]
+        deadline = time.perf_counter() + args.seconds
+
+        def worker(seed_value):
+            rng = random.Random(seed_value)
+            while time.perf_counter() < deadline:
+                kind = "login" if rng.random() < args.login_ratio else "validate"
+                start = time.perf_counter()
+                try:
+                    if kind == "login":
+                        login_op(Session, args.users, rng)
+                    else:
+                        validate_op(Session, session_ids, rng)
+                except Exception:
+                    errors[0] += 1
+                    continue
+                latencies[kind].append((time.perf_counter() - start) * 1000)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        engine.dispose()
+
+    print(f"\n== {profile} ({args.threads} threads, {args.seconds}s, errors {errors[0]})")
+    for kind, samples in latencies.items():
+        if not samples:
+            continue
+        samples.sort()
+        print(f"{kind:9} {len(samples) / args.seconds:9.0f} ops/s"
+              f"  p50 {statistics.median(samples):7.2f} ms"
+              f"  p99 {samples[int(len(samples) * 0.99) - 1]:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--sessions", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--login-ratio", type=float, default=0.05)
+    args = parser.parse_args()
+
+    for profile in ("default", "tuned"):
+        run(profile, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Cost of encrypting the stored IdP tokens (TOKEN_ENCRYPTION_KEYS).
+
+- per token: AES-GCM with the cached key vs deriving the key on every call
+- get_current_user with every call loading the session row (SESSION_CACHE_TTL=0,
+  the worst case): cipher calls per request and their cost, plus wall-clock
+  with the cipher on vs off. The token columns are deferred, so this path
+  shouldn't decrypt anything
+- the same for a token refresh, which reads both tokens and writes new ones
+- background re-encryption throughput after a key rotation
+
+Wall-clock differences of a few microseconds drown in run-to-run noise, so
+the budget is checked on cipher calls per request times their measured cost:
+exits non-zero if encryption adds more than BUDGET_US microseconds to a
+get_current_user call, or if re-encryption misses rows.
+
+    python -m benchmarks.token_cipher --sessions 20000 --calls 5000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from .run import configure
+
+BUDGET_US = 15
+
+
+def per_call(func, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20_000)
+    parser.add_argument("--calls", type=int, default=5_000)
+    parser.add_argument("--rounds", type=int, default=5, help="alternating on/off rounds, the best is kept")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="nauth-cipher-")
+    os.environ.setdefault("TOKEN_ENCRYPTION_KEYS", "bench2:second-secret,bench1:first-secret")
+    # every get_current_user loads the row
+    os.environ["SESSION_CACHE_TTL"] = "0"
+    configure(tmp)
+
+    from sqlalchemy.orm import undefer_group
+    from starlette.requests import Request
+
+    from core import token_cipher
+    from core.auth import get_current_user
+    from core.database.database import SessionLocal, engine
+    from core.database.migrations import upgrade
+    from core.database.models import UserSession
+    from core.token_rotation import TokenRotation
+
+    from .seed import generate_sessions, insert_sessions
+
+    cipher = token_cipher.cipher
+    access, refresh = "eyJ" + "a" * 900, "v1." + "r" * 40
+    aad = b"access_token"
+    sealed = cipher.encrypt(access, aad)
+
+    def derive_per_call():
+        keys = token_cipher.parse_keys(os.environ["TOKEN_ENCRYPTION_KEYS"])
+        token_cipher.TokenCipher(keys).decrypt(sealed, aad)
+
+    cost = {
+        "encrypt": per_call(lambda: cipher.encrypt(access, aad), 20_000),
+        "decrypt": per_call(lambda: cipher.decrypt(sealed, aad), 20_000),
+    }
+    print("per token (900 byte access token):")
+    print(f"  encrypt, cached key       {cost['encrypt']:8.2f} us")
+    print(f"  decrypt, cached key       {cost['decrypt']:8.2f} us")
+    print(f"  decrypt, key derived      {per_call(derive_per_call, 2_000):8.2f} us")
+
+    # sessions written under the old key, as after a rotation
+    upgrade(engine)
+    token_cipher.cipher = token_cipher.TokenCipher(token_cipher.parse_keys("bench1:first-secret"))
+    exp = int(time.time()) + 86400
+    rows = []
+    for row in generate_sessions(args.sessions, max(args.sessions // 3, 1), active_ratio=1.0):
+        row.update(access_token=access, refresh_token=refresh, access_token_exp=exp)
+        rows.append(row)
+    insert_sessions(engine, iter(rows))
+    token_cipher.cipher = cipher
+
+    session_ids = [row["session_id"] for row in rows]
+    sample = random.Random(7).choices(session_ids, k=args.calls)
+    requests = [Request({"type": "http", "headers": [(b"cookie", f"session_id={sid}".encode())]})
+                for sid in sample]
+
+    def current_user_calls():
+        with SessionLocal() as db:
+            for request in requests:
+                get_current_user(request, db)
+                db.expunge_all()
+
+    def token_refreshes():
+        # what a refresh does around the IdP call: read both tokens, write new ones
+        with SessionLocal() as db:
+            for sid in sample:
+                session = db.get(UserSession, sid, options=[undefer_group("tokens")])
+                session.access_token, session.refresh_token = session.refresh_token, session.access_token
+                db.flush()
+                db.expunge_all()
+            db.rollback()
+
+    # count what each path asks of the cipher
+    calls = Counter()
+
+    def counted(name):
+        func = getattr(cipher, name)
+
+        def wrapper(*a):
+            calls[name] += 1
+            return func(*a)
+        return wrapper
+
+    def cipher_cost(run):
+        calls.clear()
+        cipher.encrypt, cipher.decrypt = counted("encrypt"), counted("decrypt")
+        try:
+            run()
+        finally:
+            del cipher.encrypt, cipher.decrypt
+        per_request = {name: count / args.calls for name, count in calls.items()}
+        return per_request, sum(cost[name] * n for name, n in per_request.items())
+
+    def wall_clock(run):
+        """Best per-call time with the cipher off and on, alternating rounds."""
+        best = {"off": float("inf"), "on": float("inf")}
+        run()  # warm up the statement caches
+        for _ in range(args.rounds):
+            for mode in best:
+                token_cipher.cipher = cipher if mode == "on" else None
+                start = time.perf_counter()
+                run()
+                best[mode] = min(best[mode], (time.perf_counter() - start) / args.calls * 1e6)
+        token_cipher.cipher = cipher
+        return best["off"], best["on"]
+
+    results = {}
+    for name, run in (("get_current_user, session row loaded every call", current_user_calls),
+                      ("token refresh, database part", token_refreshes)):
+        per_request, added = cipher_cost(run)
+        off, on = wall_clock(run)
+        results[name] = added
+        ops = ", ".join(f"{n:.1f} {op}" for op, n in sorted(per_request.items())) or "none"
+        print(f"{name}:")
+        print(f"  cipher calls per request  {ops}")
+        print(f"  cipher time per request   {added:8.2f} us")
+        print(f"  wall clock, off / on      {off:8.2f} / {on:.2f} us")
+
+    current_user = results["get_current_user, session row loaded every call"]
+    print(f"get_current_user budget: {current_user:.2f} us of {BUDGET_US} us")
+
+    rotation = TokenRotation(batch_size=1000, max_batches=sys.maxsize)
+    start = time.perf_counter()
+    rotation.rotate()
+    elapsed = time.perf_counter() - start
+    print(f"re-encryption: {rotation.rotated} rows in {elapsed:.2f}s "
+          f"({rotation.rotated / elapsed:,.0f} rows/s), {rotation.failed} failed")
+
+    ok = current_user <= BUDGET_US and rotation.rotated == args.sessions and rotation.failed == 0
+    print("ok" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
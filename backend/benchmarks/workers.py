@@ -0,0 +1,192 @@
+"""
+Multi-worker mode, locally: N processes each run their own copy of the app
+against one shared database, with pending logins and session invalidations
+on the database backends.
+
+First checks that state really is shared (a login started on one worker
+finishes on another, a force logout on one is seen by the other's session
+cache), then measures throughput of a validate/login mix for each worker
+count. Each worker drives its own load, so the numbers only scale with the
+cores the machine has.
+
+    python -m benchmarks.workers --workers 1 2 4 --requests 2000
+    DATABASE_URL=postgresql://... python -m benchmarks.workers
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs, urlparse
+
+from .harness import run_load
+from .run import configure
+
+SHARED_STATE = {
+    "PENDING_LOGIN_BACKEND": "database",
+    "SESSION_INVALIDATION_BACKEND": "database",
+    "SESSION_INVALIDATION_POLL_INTERVAL": "0.2",
+}
+
+
+def _clients(client_ip="127.0.0.1"):
+    import httpx
+
+    import main
+    from core import idp
+    from devtools import fake_idp as fake_idp_app
+
+    idp._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_idp_app.app),
+                                    base_url=os.environ["IDP_BASE_URL"])
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app, client=(client_ip, 50000)),
+                               base_url="http://backend.local")
+    return main, fake_idp_app.idp, client
+
+
+async def _login_id(client, code):
+    r = await client.get("/token", params={"code": code})
+    return parse_qs(urlparse(r.headers["location"]).query)["login_id"][0]
+
+
+async def _consistency_peer(role, conn):
+    main, fake_idp, client = _clients("192.0.2.1" if role == "a" else "192.0.2.2")
+    recv = lambda: asyncio.to_thread(conn.recv)
+
+    async with main.lifespan(main.app):
+        if role == "a":
+            conn.send(await _login_id(client, fake_idp.issue_code("shared@example.com")))
+            await recv()
+            r = await client.post("/logout/force", json={
+                "logout_device_ip": "192.0.2.2", "device_name": "a", "device_info": "workers"})
+            conn.send(r.json().get("affected_sessions", 0))
+            return None
+
+        # login started on worker a, finished here
+        r = await client.post("/session/check", json={
+            "login_id": await recv(), "device_name": "b", "device_info": "workers"})
+        checks = {"pending login shared": r.status_code == 200}
+        cookie = {"Cookie": f"session_id={r.cookies.get('session_id')}"}
+        checks["session valid"] = (await client.get("/session/validate", headers=cookie)).json()["valid"]
+
+        conn.send("cached")
+        checks["force logout on other worker"] = await recv() == 1
+        # give the invalidation poller a few rounds
+        await asyncio.sleep(float(os.environ["SESSION_INVALIDATION_POLL_INTERVAL"]) * 5)
+        body = (await client.get("/session/validate", headers=cookie)).json()
+        checks["cache invalidated across workers"] = body.get("reason") == "force_logged_out"
+        return checks
+
+
+def consistency_peer(role, conn, results):
+    results.put(asyncio.run(_consistency_peer(role, conn)))
+
+
+async def _load(index, requests, concurrency, active_ids, barrier):
+    main, fake_idp, client = _clients()
+    rng = random.Random(index)
+    # every 10th request is a full login, signed up front to keep RS256 out of the timings
+    codes = {i: fake_idp.issue_code(f"w{index}-{i}@example.com", presign=True)
+             for i in range(0, requests, 10)}
+
+    async with main.lifespan(main.app):
+        async def operation(i):
+            if i in codes:
+                r = await client.post("/session/check", json={
+                    "login_id": await _login_id(client, codes[i]),
+                    "device_name": "bench", "device_info": "workers"})
+            else:
+                session_id = active_ids[rng.randrange(len(active_ids))]
+                r = await client.get("/session/validate",
+                                     headers={"Cookie": f"session_id={session_id}"})
+            r.raise_for_status()
+
+        await asyncio.to_thread(barrier.wait)
+        return await run_load(operation, requests, concurrency)
+
+
+def load_worker(index, requests, concurrency, active_ids, barrier, results):
+    results.put(asyncio.run(_load(index, requests, concurrency, active_ids, barrier)))
+
+
+def run_workers(ctx, count, args, active_ids):
+    barrier = ctx.Barrier(count + 1)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=load_worker,
+                             args=(i, args.requests, args.concurrency, active_ids, barrier, results))
+                 for i in range(count)]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    start = time.perf_counter()
+    summaries = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+
+    completed = sum(s["requests"] - s["errors"] for s in summaries)
+    return {
+        "throughput": completed / elapsed,
+        "p99": max(s["p99"] for s in summaries),
+        "errors": sum(s["errors"] for s in summaries),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=2000, help="requests per worker")
+    parser.add_argument("--concurrency", type=int, default=16, help="in flight per worker")
+    parser.add_argument("--rows", type=int, default=10_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shared_db = "DATABASE_URL" in os.environ
+        database_url = os.environ.get("DATABASE_URL")
+        for name, value in SHARED_STATE.items():
+            os.environ.setdefault(name, value)
+        configure(tmp)
+        if shared_db:
+            os.environ["DATABASE_URL"] = database_url
+
+        from core.database.database import engine
+        from core.database.migrations import upgrade
+        from .seed import seed
+
+        upgrade(engine)
+        _, active_ids = seed(engine, args.rows)
+        engine.dispose()
+        print(f"Database {engine.url.render_as_string()}, {args.rows} sessions seeded")
+
+        # spawn: every worker imports its own app, caches and pollers
+        ctx = multiprocessing.get_context("spawn")
+
+        a, b = ctx.Pipe()
+        results = ctx.Queue()
+        peers = [ctx.Process(target=consistency_peer, args=("a", a, results)),
+                 ctx.Process(target=consistency_peer, args=("b", b, results))]
+        for peer in peers:
+            peer.start()
+        checks = next(r for r in (results.get(), results.get()) if r)
+        for peer in peers:
+            peer.join()
+        for name, ok in checks.items():
+            print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+
+        print(f"\n{'workers':>8}{'req/s':>12}{'speedup':>10}{'p99 ms':>10}{'errors':>8}")
+        baseline = None
+        for count in args.workers:
+            r = run_workers(ctx, count, args, active_ids[:2000])
+            baseline = baseline or r["throughput"]
+            print(f"{count:>8}{r['throughput']:>12.1f}{r['throughput'] / baseline:>9.2f}x"
+                  f"{r['p99']:>10.1f}{r['errors']:>8}")
+        print(f"\n({os.cpu_count()} cpus available)")
+
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, update
+
+from .background import PeriodicTask
+from .database.database import SessionLocal
+from .database.models import UserSession
+
+
+class LastActiveBuffer:
+    """
+    Coalesces last_active writes from /session/validate.
+    - `touch` records at most one update per session per `granularity` seconds
+    - a background task writes everything pending in one executemany UPDATE
+    - `discard` drops pending writes of invalidated sessions (logout, force
+      logout, expiry); the UPDATE also skips rows that are no longer active
+    """
+
+    def __init__(self, granularity=60, flush_interval=5, session_factory=SessionLocal):
+        self.granularity = timedelta(seconds=granularity)
+        self.session_factory = session_factory
+        self.flushed = 0
+        self._pending = {}
+        self._last_touch = {}
+        self._lock = threading.Lock()
+        self._flusher = PeriodicTask(self.flush, flush_interval, name="last-active-flush")
+
+    def __len__(self):
+        return len(self._pending)
+
+    def touch(self, session_id: str, now: datetime):
+        with self._lock:
+            last = self._last_touch.get(session_id)
+            if last is not None and now - last < self.granularity:
+                return False
+            self._last_touch[session_id] = now
+            self._pending[session_id] = now
+        return True
+
+    def discard(self, session_ids):
+        """Invalidation channel subscriber."""
+        with self._lock:
+            for session_id in session_ids:
+                self._pending.pop(session_id, None)
+                self._last_touch.pop(session_id, None)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # entries older than the window would be written on next touch anyway
+            cutoff = datetime.utcnow() - self.granularity
+            self._last_touch = {sid: t for sid, t in self._last_touch.items() if t > cutoff}
+
+        if not pending:
+            return 0
+
+        try:
+            with self.session_factory() as db:
+                # core executemany: rows closed or archived meanwhile are simply skipped
+                table = UserSession.__table__
+                db.execute(
+                    update(table)
+                    .where(table.c.session_id == bindparam("sid"), table.c.is_active == True)
+                    .values(last_active=bindparam("ts")),
+                    [{"sid": sid, "ts": ts} for sid, ts in pending.items()],
+                )
+                db.commit()
+        except Exception:
+            # put them back unless a newer touch arrived meanwhile
+            with self._lock:
+                for sid, ts in pending.items():
+                    self._pending.setdefault(sid, ts)
+            raise
+
+        self.flushed += len(pending)
+        return len(pending)
+
+    def start(self):
+        self._flusher.start()
+
+    def stop(self):
+        self._flusher.stop()
+        self.flush()
@@ -1,38 +1,160 @@
-import requests
+import asyncio
+import logging
 import uuid
-from fastapi import Depends, HTTPException, status, Request
+import hashlib
+import threading
+import time
+from fastapi import Depends, HTTPException, status, Request, Response
 from typing import Annotated
 from fastapi.security import HTTPAuthorizationCredentials
 from fastapi.security import  HTTPBearer
 from jose import jws, jwt, ExpiredSignatureError, JWTError, JWSError
 from jose.exceptions import JWTClaimsError
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
-from sqlalchemy import func 
+from sqlalchemy.orm import Session, undefer_group
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, case, or_, false, select, update, insert, literal
 
 from core.database.models import UserSession
 
 
 from .config import Config
+from .cache import TTLCache
+from .jwks import JWKSKeyStore
+from .pending import create_pending_store
+from .session_cache import SessionCache, create_invalidation_channel, session_state
+from .activity import LastActiveBuffer
+from .sweeper import SessionSweeper
+from .token_rotation import TokenRotation
+from .refresh import TokenRefresher, token_exp
+from .revocation import RevocationHub
+from .session_token import RevocationList, SessionTokens
+from .ratelimit import create_rate_limiter, enforce
+from .background import PeriodicTask
 from .schemas import SessionResponse, UserClaims
-from .database.database import get_db
+from .database.database import get_db, get_async_db, SessionLocal
+from .metrics import registry
+from . import idp, token_cipher
 
 config = Config()
 security = HTTPBearer()
-
-
-jwks_url = f"https://{config.DOMAIN}/.well-known/jwks.json"
-
-# temporary stash
-PENDING_LOGINS={}
+log = logging.getLogger(__name__)
+
+
+jwks_url = config.IDP_JWKS_URL
+
+if config.JWKS_FILE:
+    jwks_store = JWKSKeyStore.from_file(config.JWKS_FILE,
+                                        ttl=config.JWKS_CACHE_TTL,
+                                        negative_ttl=config.JWKS_NEGATIVE_TTL)
+else:
+    jwks_store = JWKSKeyStore(jwks_url,
+                              ttl=config.JWKS_CACHE_TTL,
+                              negative_ttl=config.JWKS_NEGATIVE_TTL,
+                              min_refresh_interval=config.JWKS_MIN_REFRESH_INTERVAL)
+
+# sha256(token) -> verified UserClaims
+token_cache = TTLCache(maxsize=config.TOKEN_CACHE_SIZE, ttl=config.TOKEN_CACHE_TTL)
+
+# login_id -> pending login, between /token and /session/check
+PENDING_LOGINS = create_pending_store(config)
+pending_reaper = PeriodicTask(PENDING_LOGINS.reap, config.PENDING_LOGIN_REAP_INTERVAL,
+                              name="pending-login-reaper")
+
+# session_id -> state needed for validation, invalidated on every session write
+invalidation_channel = create_invalidation_channel(config)
+session_cache = SessionCache(invalidation_channel,
+                             maxsize=config.SESSION_CACHE_SIZE,
+                             ttl=config.SESSION_CACHE_TTL)
+
+# signed session cookies; fresh tokens of sessions not in revoked_sessions skip the database
+session_tokens = None
+revoked_sessions = None
+revocation_sync = None
+if config.SESSION_TOKEN_MODE == "signed":
+    session_tokens = SessionTokens(config.SESSION_TOKEN_SECRET,
+                                   ttl=config.SESSION_TOKEN_TTL,
+                                   refresh_window=config.SESSION_TOKEN_REFRESH_WINDOW)
+    revoked_sessions = RevocationList(
+        timedelta(seconds=config.SESSION_TOKEN_TTL + config.SESSION_REVOCATION_SYNC_INTERVAL))
+    invalidation_channel.subscribe(revoked_sessions.add)
+    revocation_sync = PeriodicTask(revoked_sessions.sync, config.SESSION_REVOCATION_SYNC_INTERVAL,
+                                   name="revocation-sync", run_first=True)
+
+# rewrites stored IdP tokens that aren't under the first TOKEN_ENCRYPTION_KEYS key
+token_rotation = None
+if token_cipher.cipher is not None:
+    token_rotation = TokenRotation(interval=config.TOKEN_ROTATION_INTERVAL,
+                                   batch_size=config.TOKEN_ROTATION_BATCH)
+
+# admission control: per client ip on the login/force-logout routes, per user on /session/check
+ip_limiter = create_rate_limiter(config, "ip", config.RATE_LIMIT_IP_RATE, config.RATE_LIMIT_IP_BURST)
+user_limiter = create_rate_limiter(config, "user", config.RATE_LIMIT_USER_RATE, config.RATE_LIMIT_USER_BURST)
+rate_limit_reaper = PeriodicTask(lambda: ip_limiter.reap() + user_limiter.reap(), 60,
+                                 name="rate-limit-reaper")
+
+# open /session/events streams, told about every invalidated session
+revocation_hub = RevocationHub(heartbeat=config.SESSION_EVENTS_HEARTBEAT)
+invalidation_channel.subscribe(revocation_hub.on_invalidated)
+
+# debounced last_active writes, flushed in batches; closed sessions' writes are dropped
+last_active_buffer = LastActiveBuffer(granularity=config.LAST_ACTIVE_GRANULARITY,
+                                      flush_interval=config.LAST_ACTIVE_FLUSH_INTERVAL)
+invalidation_channel.subscribe(last_active_buffer.discard)
+
+# striped locks so threads refreshing the same session do it once
+refresh_locks = [threading.Lock() for _ in range(64)]
+
+# striped per-user locks around check_session_async; MAX_N itself is enforced
+# by admit_session, these stop a process from racing itself (e.g. a
+# double-submitted login creating two sessions for the same device)
+admission_locks = [asyncio.Lock() for _ in range(256)]
+
+# closes expired sessions and archives old closed ones in the background
+session_sweeper = SessionSweeper(
+    on_expired=lambda session_ids: session_cache.invalidate(*session_ids),
+    interval=config.SESSION_SWEEP_INTERVAL,
+    batch_size=config.SESSION_SWEEP_BATCH,
+    max_batches=config.SESSION_SWEEP_MAX_BATCHES,
+    archive_after=timedelta(days=config.SESSION_ARCHIVE_AFTER_DAYS),
+    retention=(timedelta(days=config.SESSION_ARCHIVE_RETENTION_DAYS)
+               if config.SESSION_ARCHIVE_RETENTION_DAYS else None),
+)
+
+def read_session_cookie(request: Request):
+    """(session_id, token claims) from the cookie; claims is None for opaque ids, session_id None if forged."""
+    cookie = request.cookies.get("session_id")
+    if not cookie or session_tokens is None:
+        return cookie, None
+    claims = session_tokens.verify(cookie)
+    if claims is None:
+        # opaque ids from before signed mode was turned on still go through the database
+        return (None if "." in cookie else cookie), None
+    return claims["sid"], claims
+
+def trusted_claims(claims):
+    """Token claims good enough without a database lookup: fresh and not possibly revoked."""
+    return (claims is not None and session_tokens.fresh(claims)
+            and claims["sid"] not in revoked_sessions)
+
+def set_session_cookie(response, session_id, user_id, expires_at, now):
+    value = session_id
+    if session_tokens is not None:
+        value = session_tokens.issue(session_id, user_id, expires_at)
+    response.set_cookie(
+        key="session_id",
+        value=value,
+        httponly=True,
+        secure=False, #########
+        samesite="lax",
+        max_age=int((expires_at - now).total_seconds())
+    )
 
 def get_public_key(kid: str):
-    jwks = requests.get(jwks_url).json()
-    for key in jwks["keys"]:
-        if key["kid"] == kid:
-            return key
-        
-    raise Exception("Public key not Found")
+    key = jwks_store.get_key(kid)
+    if key is None:
+        raise JWTError("Public key not found")
+    return key
 
 def validate_token(credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]):
 
@@ -44,6 +166,11 @@ def validate_token(credentials: Annotated[HTTPAuthorizationCredentials, Depends(
         credentials.credentials = credentials.credentials.strip().strip("'").strip('"')
 
         # print("Clean credentials.credentials repr:", repr(credentials.credentials))
+        token_digest = hashlib.sha256(credentials.credentials.encode()).digest()
+        cached_claims = token_cache.get(token_digest)
+        if cached_claims is not None:
+            return cached_claims
+
         parts = credentials.credentials.split(".")
         # print("credentials.credentials parts count:", len(parts))
         if len(parts) != 3:
@@ -53,7 +180,7 @@ def validate_token(credentials: Annotated[HTTPAuthorizationCredentials, Depends(
         # header
         unverified_header = jwt.get_unverified_header(credentials.credentials)
 
-        # get JWK (dict with "kty", "n", "e", etc.)
+        # get constructed public key for the kid
         jwk_key = get_public_key(unverified_header["kid"])
 
         # decode
@@ -64,9 +191,12 @@ def validate_token(credentials: Annotated[HTTPAuthorizationCredentials, Depends(
             audience=config.API_AUDIENCE,
             issuer=f"https://{config.DOMAIN}/",
         )
-        return UserClaims(
+        user_claims = UserClaims(
                 sub=payload["sub"], permissions=payload.get("permissions", [])
             )
+        # never serve the claims past the token's own expiry
+        token_cache.set(token_digest, user_claims, expires_at=payload.get("exp"))
+        return user_claims
     except (
         ExpiredSignatureError,
         JWTError,
@@ -76,7 +206,17 @@ def validate_token(credentials: Annotated[HTTPAuthorizationCredentials, Depends(
         raise HTTPException(status_code=401, detail=str(error))
 
 
-def process_login_token(token_response:str):
+def require_permission(permission: str):
+    """Dependency: bearer token that carries `permission`."""
+    def dependency(user_claims: UserClaims = Depends(validate_token)):
+        if permission not in user_claims.permissions:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                                detail=f"Missing permission {permission}")
+        return user_claims
+    return dependency
+
+
+def _pending_login(token_response):
 
     access_token = token_response["access_token"]
     id_token = token_response["id_token"]
@@ -93,18 +233,30 @@ def process_login_token(token_response:str):
         raise HTTPException(status_code=400, detail="Missing user identity")
     
     login_id = str(uuid.uuid4())
-    PENDING_LOGINS[login_id] ={
+    data = {
         "email":email,
         "name":name,
         "sub":sub,
         "tokens": token_response,
-        "created_at": datetime.utcnow()
+        "created_at": datetime.utcnow().isoformat()
     }
+    return login_id, data, id_token, access_token
+
+
+def process_login_token(token_response:str):
+    login_id, data, id_token, access_token = _pending_login(token_response)
+    PENDING_LOGINS.put(login_id, data)
     # print(PENDING_LOGINS)
 
     return login_id, id_token, access_token
 
 
+async def process_login_token_async(token_response: dict):
+    login_id, data, id_token, access_token = _pending_login(token_response)
+    await PENDING_LOGINS.put_async(login_id, data)
+    return login_id, id_token, access_token
+
+
 def logout_session(session_id: str, db:Session):
     session = db.query(UserSession).filter_by(
         session_id = session_id,
@@ -116,11 +268,72 @@ def logout_session(session_id: str, db:Session):
         session.closed_at = datetime.utcnow()
         session.closed_reason = "user_logout"
         db.commit()
+        session_cache.invalidate(session_id)
 
         return True
     return False
 
 
+def bulk_forced_logout(db,
+                       forced_by_ip,
+                       device_name,
+                       device_info,
+                       device_ips=(),
+                       session_ids=(),
+                       user_emails=()):
+    """
+    Close every active session matching any of the given ips, session ids
+    or user emails with one UPDATE ... RETURNING, without loading ORM objects.
+    Returns the closed (session_id, device_ip, user_email) rows.
+    """
+    conditions = []
+    if device_ips:
+        conditions.append(UserSession.device_ip.in_(device_ips))
+    if session_ids:
+        conditions.append(UserSession.session_id.in_(session_ids))
+    if user_emails:
+        conditions.append(UserSession.user_email.in_(user_emails))
+    if not conditions:
+        return []
+
+    now = datetime.utcnow()
+    closed = db.execute(
+        update(UserSession)
+        .where(UserSession.is_active == True, or_(*conditions))
+        .values(
+            is_active=False,
+            closed_at=now,
+            closed_reason="force_logout",
+            force_logged_by=forced_by_ip,
+            force_logged_at=now,
+            force_logout_message=f"Force logged out by {device_name} ({device_info})",
+        )
+        .returning(UserSession.session_id, UserSession.device_ip, UserSession.user_email)
+        .execution_options(synchronize_session=False)
+    ).all()
+    db.commit()
+
+    if closed:
+        session_cache.invalidate(*(row.session_id for row in closed))
+    return closed
+
+
+def bulk_forced_logout_summary(closed):
+    by_device_ip = {}
+    by_user = {}
+    for row in closed:
+        by_device_ip[row.device_ip] = by_device_ip.get(row.device_ip, 0) + 1
+        by_user[row.user_email] = by_user.get(row.user_email, 0) + 1
+    return {
+        "success": bool(closed),
+        "message": (f"Successfully force logged out {len(closed)} sessions"
+                    if closed else "No active sessions found"),
+        "affected_sessions": len(closed),
+        "affected_by_device_ip": by_device_ip,
+        "affected_by_user": by_user,
+    }
+
+
 def forced_logout(logout_device_ip,
                   device_ip,
                   device_name,
@@ -128,39 +341,25 @@ def forced_logout(logout_device_ip,
                   request, db):
 
     try:
-        now = datetime.utcnow()
-        sessions = db.query(UserSession).filter(
-            UserSession.device_ip == logout_device_ip, UserSession.is_active == True
-        ).all()
-
-        # print(sessions)
+        closed = bulk_forced_logout(db, device_ip, device_name, device_info,
+                                    device_ips=[logout_device_ip])
 
-        if not sessions:
+        if not closed:
             return {
                 "success": False,
                 "message": "No active sessions found for this device",
                 "affected_sessions": 0
             }
-        
-        for session in sessions:
-            session.is_active = False
-            session.closed_at = now
-            session.closed_reason = "force_logout"
-            session.force_logged_by = device_ip
-            session.force_logged_at = now
-            session.force_logout_message = f"Force logged out by {device_name} ({device_info})"
-
-        db.commit()
 
         return {
             "success": True,
-            "message": f"Successfully force logged out {len(sessions)} sessions",
-            "affected_sessions": len(sessions)
+            "message": f"Successfully force logged out {len(closed)} sessions",
+            "affected_sessions": len(closed)
         }
 
     except Exception as e:
         db.rollback()
-        print("Exception in forced_logout:", str(e))
+        log.exception("forced_logout failed")
         raise HTTPException(
             status_code= status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail = f"Force logout failed: {str(e)}"
@@ -176,20 +375,24 @@ def check_session(  login_id,
                     device_info,
                     device_name,
                     response,
-                    db):
+                    db,
+                    login_data=None):
     """
     - validate login_id and pending login
     - check for active sessions
     - if already active we reuse the same session
-    - if not we check MAX_N and create new session accordingly
+    - if not we check MAX_N and create new session accordingly,
+      the insert itself re-checks MAX_N so concurrent logins can't overshoot it
+    - callers passing `login_data` have already consumed the pending login
     """
+    consume_login = login_data is None
     try:
-        print("Inside check")
-        if login_id not in PENDING_LOGINS:
+        if login_data is None:
+            login_data = PENDING_LOGINS.get(login_id)
+        if login_data is None:
             raise HTTPException(status_code=400,
                                 detail="Invalid or expired login")
         
-        login_data = PENDING_LOGINS[login_id]
         user_id = login_data["sub"]
         user_email = login_data["email"]
 
@@ -200,40 +403,25 @@ def check_session(  login_id,
 
         now = datetime.utcnow()
 
-        # # filter active sessions for the user
-        device_list = get_active_devices_for_user(db, user_email)
-        print(device_list)
-        
+        # active devices and the current device's session in one round trip
+        device_list, existing = get_login_snapshot(db, user_email, device_ip,
+                                                   device_name, device_info)
 
-        # check active session for current device
-        existing =(
-            db.query(UserSession).filter_by(
-                user_email = user_email,
-                device_ip = device_ip,
-                device_info = device_info,
-                device_name = device_name,
-                is_active=True
-            ).first()
-        )
-
-        if existing and existing.expires_at > now:
-            existing.last_active = now
+        if existing and existing[1] > now:
+            existing_id, existing_expires_at = existing
+            db.query(UserSession).filter_by(session_id=existing_id).update(
+                {"last_active": now}, synchronize_session=False
+            )
             # existing.access_token = access_token
-            print("Cookie exists")
             db.commit()
+            log.info("session reused", extra={"user_id": user_id})
 
-            response.set_cookie(
-                key="session_id",
-                value=existing.session_id,
-                httponly=True,
-                secure=False, #########
-                samesite="lax",
-                max_age=int((existing.expires_at - now).total_seconds())
-            )
+            set_session_cookie(response, existing_id, user_id, existing_expires_at, now)
 
-            PENDING_LOGINS.pop(login_id, None)
+            if consume_login:
+                PENDING_LOGINS.pop(login_id)
             return SessionResponse(success=True, 
-                                session_id=existing.session_id, 
+                                session_id=existing_id, 
                                 message="Session reused")
         
         # if new device
@@ -243,22 +431,19 @@ def check_session(  login_id,
         device_exists = any(d["device_ip"] == device_ip for d in device_list)
         
         if not device_exists and device_count >= int(config.MAX_N):
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail={"message": "Max devices reached", "devices": device_list}
-            )
+            log.info("max devices reached", extra={"user_id": user_id, "active_devices": device_count})
+            raise max_devices_error(device_list)
 
         # if allowed create new session
         if existing:
-            existing.is_active = False
-            existing.closed_at = now
-            existing.closed_reason = "cookie_expired"
+            db.query(UserSession).filter_by(session_id=existing[0]).update(
+                {"is_active": False, "closed_at": now, "closed_reason": "cookie_expired"},
+                synchronize_session=False
+            )
         session_id = str(uuid.uuid4())
         expires_at = now + timedelta(days=30)
 
-        print("Creating new session")
-
-        new_session = UserSession(
+        new_session = dict(
             session_id=session_id,
             user_id=user_id,
             user_email=user_email,
@@ -266,134 +451,371 @@ def check_session(  login_id,
             device_info=device_info,
             device_name = device_name,
             access_token=access_token,
+            access_token_exp=token_exp(access_token),
             refresh_token=refresh_token,
             created_at=now,
             last_active=now,
             expires_at=expires_at,
             is_active=True
         )
-        db.add(new_session)
+        if not admit_session(db, new_session, int(config.MAX_N), now):
+            # another login took the last slot since the snapshot
+            db.rollback()
+            device_list, _ = get_login_snapshot(db, user_email)
+            log.info("max devices reached", extra={"user_id": user_id, "active_devices": len(device_list)})
+            raise max_devices_error(device_list)
+        new_state = session_state(UserSession(**new_session))
         db.commit()
 
-        response.set_cookie(
-            key="session_id",
-            value=session_id,
-            httponly=True,
-            secure=False,   #################
-            samesite="lax",
-            max_age=int((expires_at - now).total_seconds())
-        )
+        # write-through: the new session is validated right after login
+        if existing:
+            session_cache.invalidate(existing[0])
+        session_cache.put(session_id, new_state)
+
+        set_session_cookie(response, session_id, user_id, expires_at, now)
 
-        print("Check out")
-        PENDING_LOGINS.pop(login_id, None)
+        log.info("session created", extra={"user_id": user_id})
+        if consume_login:
+            PENDING_LOGINS.pop(login_id)
         return {"success": True, "session_id": session_id, "message": "New session created"}
     except HTTPException as he:
         raise he
     except Exception as e:
         db.rollback()
-        print("Exception in check_session:", str(e))
+        log.exception("check_session failed")
         raise HTTPException(
             status_code= status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail = f"Session creation failed: {str(e)}"
         )
 
-def get_active_devices_for_user(db: Session, user_email: str):
-    now = datetime.utcnow()
+def login_snapshot_query(user_email: str, now: datetime, device_ip=None,
+                         device_name=None, device_info=None):
+    """The grouped query behind get_login_snapshot, one row per (ip, device name)."""
+    if device_ip is None:
+        is_current = false()
+    else:
+        # one row for this device, the latest-expiring, so id and expiry come from the same session
+        current_id = (
+            select(UserSession.session_id)
+            .where(
+                UserSession.user_email == user_email,
+                UserSession.is_active == True,
+                UserSession.device_ip == device_ip,
+                UserSession.device_name == device_name,
+                UserSession.device_info == device_info,
+            )
+            .order_by(UserSession.expires_at.desc(), UserSession.session_id.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        is_current = UserSession.session_id == current_id
 
-    # Get all active sessions with their IPs and counts
-    sessions_per_ip = (
-        db.query(
+    return (
+        select(
             UserSession.device_ip,
-            func.count(UserSession.session_id).label("total_sessions"),
+            UserSession.device_name,
+            func.sum(case((UserSession.expires_at > now, 1), else_=0)).label("live_sessions"),
+            func.max(case((is_current, UserSession.session_id))).label("current_session_id"),
+            func.max(case((is_current, UserSession.expires_at))).label("current_expires_at"),
         )
-        .filter(
+        .where(
             UserSession.user_email == user_email,
-            UserSession.is_active == True,
-            UserSession.expires_at > now
+            UserSession.is_active == True
         )
-        .group_by(UserSession.device_ip)
-        .all()
+        .group_by(UserSession.device_ip, UserSession.device_name)
     )
-    
-    # Get distinct device names per IP - Fix the syntax error here
-    device_names_query = (
-        db.query(
-            UserSession.device_ip,
-            UserSession.device_name
-        )
-        .filter(
-            UserSession.user_email == user_email,
-            UserSession.is_active == True,
-            UserSession.expires_at > now
+
+def get_login_snapshot(db: Session, user_email: str, device_ip=None,
+                       device_name=None, device_info=None):
+    """
+    Single grouped query over the user's active sessions.
+    - device_list: unexpired sessions per ip with their distinct device names
+    - existing: (session_id, expires_at) of an active session on this exact
+      device, expired or not, else None
+    """
+    rows = db.execute(
+        login_snapshot_query(user_email, datetime.utcnow(), device_ip, device_name, device_info)
+    ).all()
+
+    devices = {}
+    existing = None
+    for ip, name, live_sessions, current_session_id, current_expires_at in rows:
+        if current_session_id is not None:
+            existing = (current_session_id, current_expires_at)
+        if not live_sessions:
+            continue
+        device = devices.get(ip)
+        if device is None:
+            device = devices[ip] = {"device_ip": ip, "device_names": [], "session_count": 0}
+        device["device_names"].append(name)
+        device["session_count"] += live_sessions
+
+    return list(devices.values()), existing
+
+def admission_condition(user_email: str, device_ip: str, max_devices: int, now: datetime):
+    """True if the device is already active for the user or the user has room for another one."""
+    live = (
+        UserSession.user_email == user_email,
+        UserSession.is_active == True,
+        UserSession.expires_at > now,
+    )
+    device_active = select(UserSession.session_id).where(
+        *live, UserSession.device_ip == device_ip
+    ).exists()
+    active_devices = select(func.count(func.distinct(UserSession.device_ip))).where(*live)
+    return or_(device_active, active_devices.scalar_subquery() < max_devices)
+
+def admit_session(db: Session, values: dict, max_devices: int, now: datetime) -> bool:
+    """
+    Insert the session only if its device is already active for the user or
+    the user has fewer than `max_devices` active devices. Check and insert
+    are one INSERT ... SELECT, so it holds across threads and workers
+    (sqlite runs one writer at a time, and the statement reads under its lock).
+    On postgres a per-user advisory lock, held until commit, does the same.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(select(func.pg_advisory_xact_lock(func.hashtext(values["user_email"]))))
+
+    columns = UserSession.__table__.c
+    row = select(*(literal(value, columns[name].type).label(name) for name, value in values.items()))
+    result = db.execute(
+        insert(UserSession).from_select(
+            list(values),
+            row.where(admission_condition(values["user_email"], values["device_ip"], max_devices, now)),
         )
-        .distinct()
-        .all()
     )
-    
-    # Create IP to names mapping
-    ip_to_names = {}
-    for ip, name in device_names_query:
-        if ip not in ip_to_names:
-            ip_to_names[ip] = []
-        ip_to_names[ip].append(name)
-
-    # Combine the data
-    device_list = [
-        {
-            "device_ip": ip,
-            "device_names": ip_to_names.get(ip, []),
-            "session_count": total_sessions
-        }
-        for ip, total_sessions in sessions_per_ip
-    ]
-    
+    return result.rowcount == 1
+
+
+def max_devices_error(device_list):
+    return HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail={"message": "Max devices reached", "devices": device_list}
+    )
+
+
+def get_active_devices_for_user(db: Session, user_email: str):
+    device_list, _ = get_login_snapshot(db, user_email)
     return device_list
 
 ## authorization functions
 
 def refresh_access_token(refresh_token: str):
-    payload = {
-        "grant_type":"refresh_token",
-        "client_id": config.CLIENT_ID,
-        "client_secret": config.CLIENT_SECRET,
-        "refresh_token":refresh_token
-    }
-
-    res = requests.post(f"https://{config.DOMAIN}/oauth/token",data=payload)
+    res = idp.refresh_tokens_sync(refresh_token)
     if res.status_code != 200:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Refresh token expired or invalid")
     
     return res.json()
 
+def access_token_exp(db: Session, state: dict):
+    exp = state["access_token_exp"]
+    if exp is None:
+        # rows stored before access_token_exp existed: parse once and backfill
+        session = db.get(UserSession, state["session_id"])
+        exp = token_exp(session.access_token)
+        if exp is not None:
+            db.query(UserSession).filter_by(session_id=state["session_id"]).update(
+                {"access_token_exp": exp}, synchronize_session=False
+            )
+            db.commit()
+            state["access_token_exp"] = exp
+    return exp
+
 def get_current_user(request: Request, db: Session = Depends(get_db)):
-    session_id = request.cookies.get("session_id")
+    session_id, claims = read_session_cookie(request)
     if not session_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Not authenticated")
+    if trusted_claims(claims):
+        # the token carries no email; a cached session has it without a database read
+        state = session_cache.get(session_id)
+        if state is not None:
+            return {"user_id": claims["uid"], "email": state["user_email"]}
     
-    session = db.query(UserSession).filter_by(session_id=session_id, is_active=True).first()
-    if not session:
+    state = session_cache.load(db, session_id)
+    if not state or not state["is_active"]:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Session not found")
     
+    exp = access_token_exp(db, state)
+    if exp is not None and exp <= time.time():
+        with refresh_locks[hash(session_id) % len(refresh_locks)]:
+            session = db.get(UserSession, session_id)
+            db.refresh(session)
+            # another thread may have refreshed while we waited for the lock
+            if session.access_token_exp is None or session.access_token_exp <= time.time():
+                tokens = refresh_access_token(session.refresh_token)
+                session.access_token = tokens["access_token"]
+                session.access_token_exp = token_exp(tokens["access_token"])
+                if "refresh_token" in tokens:
+                    session.refresh_token = tokens["refresh_token"]
+
+                db.commit()
+                session_cache.invalidate(session_id)
+
+    return {"user_id": state["user_id"], "email": state["user_email"]}
+
+## async versions
+# the session-writing functions above run unchanged on the async session's
+# connection via run_sync, so there is only one copy of the session rules
+
+async def logout_session_async(session_id: str, db: AsyncSession):
+    return await db.run_sync(lambda sync_db: logout_session(session_id, sync_db))
+
+
+async def forced_logout_async(logout_device_ip,
+                              device_ip,
+                              device_name,
+                              device_info,
+                              request, db: AsyncSession):
+    return await db.run_sync(
+        lambda sync_db: forced_logout(logout_device_ip, device_ip, device_name,
+                                      device_info, request, sync_db)
+    )
+
+
+async def bulk_forced_logout_async(db: AsyncSession, forced_by_ip, device_name, device_info,
+                                   device_ips=(), session_ids=(), user_emails=()):
+    return await db.run_sync(
+        lambda sync_db: bulk_forced_logout(sync_db, forced_by_ip, device_name, device_info,
+                                           device_ips, session_ids, user_emails)
+    )
+
+
+async def check_session_async(login_id,
+                              device_ip,
+                              device_info,
+                              device_name,
+                              response,
+                              db: AsyncSession):
+    # consumed up front (delete ... returning on the database store), so only
+    # one of several concurrent checks with the same login_id gets it
+    login_data = await PENDING_LOGINS.pop_async(login_id)
+    if login_data is None:
+        raise HTTPException(status_code=400, detail="Invalid or expired login")
+
     try:
-        jwt.decode(
-            token = session.access_token,
-            key = None,
-            algorithms=["RS256"],
-            issuer=f"https://{config.DOMAIN}/",
-            options={"verify_signature":False,"verify_aud":False}
-        )
-    except jwt.ExpiredSignatureError:
-        tokens = refresh_access_token(session.refresh_token)
-        session.access_token = tokens["access_token"]
-        if "refresh_token" in tokens:
-            session.refresh_token = tokens["refresh_token"]
+        await enforce(user_limiter, login_data["email"])
+        # one login per user at a time in this process, different users never wait on each other
+        async with admission_locks[hash(login_data["email"]) % len(admission_locks)]:
+            return await db.run_sync(
+                lambda sync_db: check_session(login_id, device_ip, device_info,
+                                              device_name, response, sync_db,
+                                              login_data=login_data)
+            )
+    except HTTPException as he:
+        if he.status_code in (status.HTTP_403_FORBIDDEN, status.HTTP_429_TOO_MANY_REQUESTS):
+            # max devices or rate limited: the login can be retried, e.g. after a force logout
+            await PENDING_LOGINS.put_async(login_id, login_data)
+        raise
 
-        db.commit()
 
-    return {"user_id": session.user_id, "email": session.user_email}
+async def refresh_access_token_async(refresh_token: str):
+    res = await idp.refresh_tokens(refresh_token)
+    if res.status_code != 200:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Refresh token expired or invalid")
+
+    return res.json()
+
+
+token_refresher = TokenRefresher(
+    refresh_access_token_async,
+    on_refreshed=session_cache.invalidate,
+    lead_time=config.TOKEN_REFRESH_LEAD_TIME,
+    concurrency=config.TOKEN_REFRESH_CONCURRENCY,
+)
+
+
+async def access_token_exp_async(db: AsyncSession, state: dict):
+    exp = state["access_token_exp"]
+    if exp is None:
+        # rows stored before access_token_exp existed: parse once and backfill
+        session = await db.get(UserSession, state["session_id"], options=[undefer_group("tokens")])
+        exp = token_exp(session.access_token)
+        if exp is not None:
+            await db.execute(
+                update(UserSession)
+                .where(UserSession.session_id == state["session_id"])
+                .values(access_token_exp=exp)
+            )
+            await db.commit()
+            state["access_token_exp"] = exp
+    return exp
+
+
+async def get_current_user_async(request: Request, response: Response,
+                                 db: AsyncSession = Depends(get_async_db)):
+    session_id, claims = read_session_cookie(request)
+    if not session_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Not authenticated")
+    if trusted_claims(claims):
+        # the token carries no email; a cached session has it without a database read
+        state = session_cache.get(session_id)
+        if state is not None:
+            return {"user_id": claims["uid"], "email": state["user_email"]}
+
+    state = await session_cache.load_async(db, session_id)
+    if not state or not state["is_active"]:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Session not found")
+
+    exp = await access_token_exp_async(db, state)
+    if exp is not None and exp <= time.time():
+        # single-flight: concurrent requests share one refresh
+        access_token = await token_refresher.refresh(session_id)
+        if access_token is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                detail="Session not found")
+    else:
+        # refresh in the background before it expires
+        token_refresher.track(session_id, exp)
+
+    if session_tokens is not None:
+        # checked against the database, good for another SESSION_TOKEN_TTL
+        set_session_cookie(response, session_id, state["user_id"], state["expires_at"], datetime.utcnow())
+    return {"user_id": state["user_id"], "email": state["user_email"]}
 
 # print(process_login_token(token))
 
+
+
+def count_active_sessions():
+    db = SessionLocal()
+    try:
+        return db.scalar(
+            select(func.count()).select_from(UserSession)
+            .where(UserSession.is_active == True, UserSession.expires_at > datetime.utcnow())
+        )
+    finally:
+        db.close()
+
+
+# read at scrape time by /metrics
+registry.gauge("cache_hit_ratio", "Hit ratio of the in-process caches",
+               lambda: {"token": token_cache.stats()["hit_rate"],
+                        "session": session_cache.stats()["hit_rate"],
+                        "jwks": jwks_store.stats()["hit_rate"]},
+               ("cache",))
+registry.gauge("cache_entries", "Entries held by the in-process caches",
+               lambda: {"token": len(token_cache), "session": len(session_cache),
+                        "jwks": len(jwks_store)},
+               ("cache",))
+registry.gauge("session_event_streams", "Open /session/events connections", lambda: len(revocation_hub))
+if revoked_sessions is not None:
+    registry.gauge("revocation_list", "Sessions whose signed tokens need a database check",
+                   revoked_sessions.stats,
+                   ("set",))
+if token_rotation is not None:
+    registry.gauge("token_rotation", "Stored tokens moved to the current key, and those that failed to decrypt",
+                   token_rotation.stats,
+                   ("result",))
+registry.gauge("pending_logins", "Logins waiting for /session/check", lambda: len(PENDING_LOGINS))
+registry.counter_func("pending_login_events_total",
+                      "Pending login store puts, hits, misses, reaped (expired) and evicted (over PENDING_LOGIN_MAX)",
+                      lambda: {event: getattr(PENDING_LOGINS, event)
+                               for event in ("puts", "hits", "misses", "reaped", "evicted")},
+                      ("event",))
+registry.gauge("active_sessions", "Active, unexpired sessions", count_active_sessions)
@@ -0,0 +1,48 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """
+    Runs `func` on a daemon thread every `interval` seconds until stopped.
+    `interval` can be a number or a callable returning the next delay.
+    """
+
+    def __init__(self, func, interval, name=None, run_first=False):
+        self.func = func
+        self.interval = interval
+        self.name = name or getattr(func, "__name__", "periodic-task")
+        self.run_first = run_first
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _next_interval(self):
+        interval = self.interval() if callable(self.interval) else self.interval
+        return max(float(interval), 0.01)
+
+    def _run_once(self):
+        try:
+            self.func()
+        except Exception:
+            log.exception("%s failed", self.name)
+
+    def _run(self):
+        if self.run_first:
+            self._run_once()
+        while not self._stop.wait(self._next_interval()):
+            self._run_once()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
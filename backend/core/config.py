@@ -14,4 +14,107 @@ class Config:
     SCOPE = os.getenv("SCOPE")
     BACKEND_URI = os.getenv("BACKEND_URI")
     FRONTEND_URI = os.getenv("FRONTEND_URI")
-    REDIRECT_URI = os.getenv("REDIRECT_URI")
\ No newline at end of file
+    REDIRECT_URI = os.getenv("REDIRECT_URI")
+    # defaults to auth_sessions.sqlite3 next to the code; a server database
+    # (postgresql://...) or a shared sqlite file lets several workers/nodes share state
+    DATABASE_URL = os.getenv("DATABASE_URL")
+    # derived from DATABASE_URL (sqlite -> aiosqlite, postgresql -> asyncpg) unless set
+    ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+    DB_POOL_OVERFLOW = int(os.getenv("DB_POOL_OVERFLOW", 20))
+    # authorize / token / jwks endpoints, e.g. http://127.0.0.1:9000 for devtools.fake_idp
+    IDP_BASE_URL = os.getenv("IDP_BASE_URL") or f"https://{DOMAIN}"
+    IDP_AUTHORIZE_URL = os.getenv("IDP_AUTHORIZE_URL") or f"{IDP_BASE_URL}/authorize"
+    IDP_TOKEN_URL = os.getenv("IDP_TOKEN_URL") or f"{IDP_BASE_URL}/oauth/token"
+    IDP_JWKS_URL = os.getenv("IDP_JWKS_URL") or f"{IDP_BASE_URL}/.well-known/jwks.json"
+
+    # outbound IdP client: pooled keep-alive connections, timeouts in seconds
+    IDP_CONNECT_TIMEOUT = float(os.getenv("IDP_CONNECT_TIMEOUT", 3))
+    IDP_READ_TIMEOUT = float(os.getenv("IDP_READ_TIMEOUT", 10))
+    IDP_MAX_CONNECTIONS = int(os.getenv("IDP_MAX_CONNECTIONS", 100))
+    IDP_MAX_KEEPALIVE = int(os.getenv("IDP_MAX_KEEPALIVE", 20))
+    # calls in flight per worker; callers queue up to IDP_QUEUE_TIMEOUT, then get a 503
+    IDP_MAX_CONCURRENCY = int(os.getenv("IDP_MAX_CONCURRENCY", 50))
+    IDP_QUEUE_TIMEOUT = float(os.getenv("IDP_QUEUE_TIMEOUT", 5))
+    # retries on connection errors and 429/502/503/504, full-jitter exponential backoff
+    IDP_RETRIES = int(os.getenv("IDP_RETRIES", 2))
+    IDP_RETRY_BASE_DELAY = float(os.getenv("IDP_RETRY_BASE_DELAY", 0.1))
+    IDP_RETRY_MAX_DELAY = float(os.getenv("IDP_RETRY_MAX_DELAY", 2))
+    # consecutive failures before calls fail fast, and for how long
+    IDP_BREAKER_THRESHOLD = int(os.getenv("IDP_BREAKER_THRESHOLD", 5))
+    IDP_BREAKER_COOLDOWN = float(os.getenv("IDP_BREAKER_COOLDOWN", 30))
+
+    # jwks key store
+    JWKS_FILE = os.getenv("JWKS_FILE")
+    JWKS_CACHE_TTL = int(os.getenv("JWKS_CACHE_TTL", 600))
+    JWKS_NEGATIVE_TTL = int(os.getenv("JWKS_NEGATIVE_TTL", 60))
+    JWKS_MIN_REFRESH_INTERVAL = int(os.getenv("JWKS_MIN_REFRESH_INTERVAL", 10))
+
+    # verified token cache
+    TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+    TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", 300))
+
+    # pending logins ("memory" or "database" to share them across workers)
+    PENDING_LOGIN_BACKEND = os.getenv("PENDING_LOGIN_BACKEND", "memory")
+    PENDING_LOGIN_TTL = int(os.getenv("PENDING_LOGIN_TTL", 600))
+    PENDING_LOGIN_MAX = int(os.getenv("PENDING_LOGIN_MAX", 10000))
+    PENDING_LOGIN_REAP_INTERVAL = int(os.getenv("PENDING_LOGIN_REAP_INTERVAL", 60))
+
+    # session validation cache ("local" or "database" to invalidate across workers)
+    SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 100000))
+    SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", 60))
+    SESSION_INVALIDATION_BACKEND = os.getenv("SESSION_INVALIDATION_BACKEND", "local")
+    SESSION_INVALIDATION_POLL_INTERVAL = float(os.getenv("SESSION_INVALIDATION_POLL_INTERVAL", 1.0))
+
+    # "signed": the session cookie is a short-lived HMAC-signed token checked without the database
+    SESSION_TOKEN_MODE = os.getenv("SESSION_TOKEN_MODE", "opaque")
+    SESSION_TOKEN_SECRET = os.getenv("SESSION_TOKEN_SECRET", "")
+    SESSION_TOKEN_TTL = int(os.getenv("SESSION_TOKEN_TTL", 300))
+    SESSION_TOKEN_REFRESH_WINDOW = int(os.getenv("SESSION_TOKEN_REFRESH_WINDOW", 60))
+    SESSION_REVOCATION_SYNC_INTERVAL = float(os.getenv("SESSION_REVOCATION_SYNC_INTERVAL", 10))
+
+    # token buckets on /token, /session/check and /logout/force; a rate of 0 turns a limiter off
+    RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    RATE_LIMIT_IP_RATE = float(os.getenv("RATE_LIMIT_IP_RATE", 2))        # requests/second per client ip
+    RATE_LIMIT_IP_BURST = int(os.getenv("RATE_LIMIT_IP_BURST", 20))
+    RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", 0.2))  # logins/second per user_email
+    RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", 10))
+    RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+
+    # AES-GCM for the stored IdP tokens, "kid:secret,kid:secret": the first key encrypts,
+    # the others only decrypt; rows under other keys are rewritten in the background
+    TOKEN_ENCRYPTION_KEYS = os.getenv("TOKEN_ENCRYPTION_KEYS", "")
+    TOKEN_ROTATION_INTERVAL = float(os.getenv("TOKEN_ROTATION_INTERVAL", 60))
+    TOKEN_ROTATION_BATCH = int(os.getenv("TOKEN_ROTATION_BATCH", 500))
+
+    # seconds between keep-alive comments on /session/events (proxies drop idle streams)
+    SESSION_EVENTS_HEARTBEAT = float(os.getenv("SESSION_EVENTS_HEARTBEAT", 25))
+
+    # batched last_active writes from /session/validate
+    LAST_ACTIVE_GRANULARITY = int(os.getenv("LAST_ACTIVE_GRANULARITY", 60))
+    LAST_ACTIVE_FLUSH_INTERVAL = float(os.getenv("LAST_ACTIVE_FLUSH_INTERVAL", 5))
+
+    # sqlite ("tuned" = WAL, synchronous=NORMAL, larger pool and caches; "default" = driver defaults)
+    SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "tuned")
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+    SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 65536))
+    SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))
+    SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", 20))
+    SQLITE_POOL_OVERFLOW = int(os.getenv("SQLITE_POOL_OVERFLOW", 20))
+    SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", 256))
+    SQLITE_QUERY_CACHE_SIZE = int(os.getenv("SQLITE_QUERY_CACHE_SIZE", 1000))
+
+    # expiry sweeper and archival (SESSION_ARCHIVE_RETENTION_DAYS=0 keeps archived rows forever)
+    SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", 60))
+    SESSION_SWEEP_BATCH = int(os.getenv("SESSION_SWEEP_BATCH", 1000))
+    SESSION_SWEEP_MAX_BATCHES = int(os.getenv("SESSION_SWEEP_MAX_BATCHES", 10))
+    SESSION_ARCHIVE_AFTER_DAYS = int(os.getenv("SESSION_ARCHIVE_AFTER_DAYS", 7))
+    SESSION_ARCHIVE_RETENTION_DAYS = int(os.getenv("SESSION_ARCHIVE_RETENTION_DAYS", 365))
+
+    # access token refresh for stored sessions
+    TOKEN_REFRESH_LEAD_TIME = int(os.getenv("TOKEN_REFRESH_LEAD_TIME", 60))
+    TOKEN_REFRESH_CONCURRENCY = int(os.getenv("TOKEN_REFRESH_CONCURRENCY", 10))
+    # logging (LOG_SAMPLE_RATES: "logger=rate,..." for info/debug records of noisy loggers)
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+    LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "session.validate=0.01")
@@ -1,8 +1,14 @@
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from ..config import Config
+from ..metrics import instrument_engine
+from .sqlite import create_sqlite_engine, create_async_sqlite_engine
+
 
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
 DB_PATH = os.path.join(BASE_DIR, "auth_sessions.sqlite3")
@@ -10,15 +16,51 @@ DB_PATH = os.path.join(BASE_DIR, "auth_sessions.sqlite3")
 
 os.makedirs(BASE_DIR, exist_ok=True)
 
-DATABASE_URL = f"sqlite:///{DB_PATH}"
+config = Config()
+
+# async driver used for each backend, ASYNC_DATABASE_URL overrides it
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+
+def async_url(url: str) -> str:
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend in ASYNC_DRIVERS:
+        url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    return url.render_as_string(hide_password=False)
+
+
+DATABASE_URL = config.DATABASE_URL or f"sqlite:///{DB_PATH}"
+ASYNC_DATABASE_URL = config.ASYNC_DATABASE_URL or async_url(DATABASE_URL)
+IS_SQLITE = make_url(DATABASE_URL).get_backend_name() == "sqlite"
+
+if IS_SQLITE:
+    engine = create_sqlite_engine(DATABASE_URL, config)
+    # async engine over the same file, for the async request path
+    async_engine = create_async_sqlite_engine(ASYNC_DATABASE_URL, config)
+else:
+    # server database shared by every worker and node
+    pool = {"pool_size": config.DB_POOL_SIZE, "max_overflow": config.DB_POOL_OVERFLOW,
+            "pool_pre_ping": True}
+    engine = create_engine(DATABASE_URL, **pool)
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool)
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+# query counts/time on /metrics
+instrument_engine(engine)
+instrument_engine(async_engine)
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,68 @@
+"""
+Schema upgrades for existing auth_sessions.sqlite3 files.
+
+create_all only creates missing tables, so columns and indexes added to a
+model later never reach a database created before them. `upgrade` fills
+that gap and is safe to run on every startup. New columns must be nullable.
+
+    python -m core.database.migrations
+"""
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from .database import Base, engine
+from . import models  # noqa: F401  (registers the tables on Base)
+
+
+def missing_columns(bind):
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        missing.extend(col for col in table.columns if col.name not in existing)
+    return missing
+
+
+def missing_indexes(bind):
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        missing.extend(ix for ix in table.indexes if ix.name not in existing)
+    return missing
+
+
+def upgrade(bind=engine):
+    """Create tables, columns and indexes missing from an older database file."""
+    Base.metadata.create_all(bind=bind)
+    created = []
+
+    columns = missing_columns(bind)
+    if columns:
+        with bind.begin() as conn:
+            for column in columns:
+                ddl = CreateColumn(column).compile(dialect=bind.dialect)
+                conn.execute(text(f"ALTER TABLE {column.table.name} ADD COLUMN {ddl}"))
+                created.append(f"{column.table.name}.{column.name}")
+
+    indexes = missing_indexes(bind)
+    for index in indexes:
+        index.create(bind=bind, checkfirst=True)
+        created.append(index.name)
+
+    if indexes:
+        # refresh planner statistics so the new indexes get picked up
+        with bind.begin() as conn:
+            conn.execute(text("ANALYZE"))
+    return created
+
+
+if __name__ == "__main__":
+    created = upgrade()
+    print("Created:", ", ".join(created) if created else "nothing, schema is up to date")
@@ -1,12 +1,12 @@
-from sqlalchemy import Column, String, DateTime, Integer, Boolean
+from sqlalchemy import Column, String, DateTime, Integer, Boolean, Index, Float
+from sqlalchemy.orm import mapped_column
 from datetime import datetime
 
+from ..token_cipher import EncryptedString, EncryptedText
 from .database import Base
 
-class UserSession(Base):
-    """Database table for storing user sessions"""
-    __tablename__ = "user_sessions"
-    
+class SessionColumns:
+    """Columns shared by live and archived sessions"""
 
     session_id = Column(String, primary_key=True, index=True)
     user_id = Column(String, nullable=False)
@@ -19,12 +19,67 @@ class UserSession(Base):
     expires_at = Column(DateTime, nullable=False)
     is_active = Column(Boolean, default=True)
 
-    access_token = Column(String, nullable=True)      # encrypted
-    refresh_token = Column(String, nullable=True)     # encrypted
+    # encrypted at rest when TOKEN_ENCRYPTION_KEYS is set, see core.token_cipher;
+    # deferred, so session lookups don't fetch and decrypt them, only the token
+    # refresh does (async callers need options=[undefer_group("tokens")])
+    access_token = mapped_column(EncryptedString("access_token"), nullable=True,
+                                 deferred=True, deferred_group="tokens")
+    refresh_token = mapped_column(EncryptedString("refresh_token"), nullable=True,
+                                  deferred=True, deferred_group="tokens")
+    # exp claim of access_token, so expiry checks need no jwt parsing
+    access_token_exp = Column(Integer, nullable=True)
 
     # force logout
     closed_at = Column(DateTime, nullable=True)
     closed_reason = Column(String, nullable=True)  # "user_logout", "force_logout", "expired"
     force_logged_by = Column(String, nullable=True)
     force_logged_at = Column(DateTime, nullable=True)
-    force_logout_message = Column(String, nullable=True)
\ No newline at end of file
+    force_logout_message = Column(String, nullable=True)
+
+
+class UserSession(SessionColumns, Base):
+    """Database table for storing user sessions"""
+    __tablename__ = "user_sessions"
+    __table_args__ = (
+        # active device lookups in check_session / get_active_devices_for_user
+        Index("ix_user_sessions_email_active_expires", "user_email", "is_active", "expires_at"),
+        # forced_logout by device ip
+        Index("ix_user_sessions_ip_active", "device_ip", "is_active"),
+        # expiry sweeper and archival
+        Index("ix_user_sessions_active_expires", "is_active", "expires_at"),
+        Index("ix_user_sessions_active_closed", "is_active", "closed_at"),
+    )
+
+
+class ArchivedUserSession(SessionColumns, Base):
+    """Closed sessions moved out of user_sessions by the sweeper"""
+    __tablename__ = "user_sessions_archive"
+
+    archived_at = Column(DateTime, nullable=False, index=True)
+
+
+class PendingLogin(Base):
+    """Logins between /token and /session/check, shared across workers"""
+    __tablename__ = "pending_logins"
+
+    login_id = Column(String, primary_key=True)
+    data = Column(EncryptedText("pending_login"), nullable=False)  # json, carries the IdP tokens
+    expires_at = Column(Float, nullable=False, index=True)  # epoch seconds
+
+
+class SessionInvalidation(Base):
+    """Session ids whose cached state other workers must drop"""
+    __tablename__ = "session_invalidations"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String, nullable=False)
+    origin = Column(String, nullable=False)  # publishing worker
+    created_at = Column(Float, nullable=False, index=True)  # epoch seconds
+
+
+class RateLimit(Base):
+    """Rate limiter buckets shared across workers (RATE_LIMIT_BACKEND=database)"""
+    __tablename__ = "rate_limits"
+
+    key = Column(String, primary_key=True)           # "<limiter>:<ip or email>"
+    tat = Column(Float, nullable=False, index=True)  # epoch seconds, next arrival with an empty bucket
@@ -0,0 +1,62 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+
+def tuned_pragmas(config) -> dict:
+    """PRAGMAs applied to every new connection with SQLITE_PROFILE=tuned."""
+    return {
+        # readers no longer block the writer and vice versa
+        "journal_mode": "WAL",
+        # fsync on checkpoint only, still durable against app crashes in WAL mode
+        "synchronous": "NORMAL",
+        "busy_timeout": config.SQLITE_BUSY_TIMEOUT_MS,
+        # negative cache_size is in KiB
+        "cache_size": -config.SQLITE_CACHE_SIZE_KB,
+        "mmap_size": config.SQLITE_MMAP_SIZE,
+        "temp_store": "MEMORY",
+    }
+
+
+def _set_pragmas(engine, pragmas):
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def _engine_kwargs(config):
+    if config.SQLITE_PROFILE == "default":
+        return {}, {}
+    if config.SQLITE_PROFILE != "tuned":
+        raise ValueError(f"Unknown SQLITE_PROFILE {config.SQLITE_PROFILE!r}")
+    connect_args = {
+        # per-connection prepared statement cache of the sqlite3 driver
+        "cached_statements": config.SQLITE_STATEMENT_CACHE,
+    }
+    engine_kwargs = {
+        "pool_size": config.SQLITE_POOL_SIZE,
+        "max_overflow": config.SQLITE_POOL_OVERFLOW,
+        # compiled SQL cache, so hot queries skip recompilation
+        "query_cache_size": config.SQLITE_QUERY_CACHE_SIZE,
+    }
+    return connect_args, engine_kwargs
+
+
+def create_sqlite_engine(url, config):
+    connect_args, engine_kwargs = _engine_kwargs(config)
+    engine = create_engine(url,
+                           connect_args={"check_same_thread": False, **connect_args},
+                           **engine_kwargs)
+    if config.SQLITE_PROFILE == "tuned":
+        _set_pragmas(engine, tuned_pragmas(config))
+    return engine
+
+
+def create_async_sqlite_engine(url, config):
+    connect_args, engine_kwargs = _engine_kwargs(config)
+    engine = create_async_engine(url, connect_args=connect_args, **engine_kwargs)
+    if config.SQLITE_PROFILE == "tuned":
+        _set_pragmas(engine.sync_engine, tuned_pragmas(config))
+    return engine
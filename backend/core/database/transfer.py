@@ -0,0 +1,299 @@
+"""
+Moving user_sessions between nodes.
+
+- export: keyset pages over the primary key, each page its own short read,
+  so memory is bounded by `chunk` and no read transaction stays open
+- two line formats, both NDJSON:
+  "rows"    one session per line
+  "columns" one page per line, {"column": [values...]}, smaller and faster
+  to parse for large moves
+- import: reads either format line by line and inserts in batches with one
+  executemany each; existing session ids are skipped or replaced. Only the
+  columns a line carries are written, so replacing from an export without
+  tokens keeps the stored tokens
+- snapshot: copy of the whole SQLite file through the online backup API
+- tokens are only exported when asked for (--tokens); they leave decrypted
+  and are encrypted again with the importing node's TOKEN_ENCRYPTION_KEYS;
+  snapshots keep them as stored
+
+    python -m core.database.transfer export --active --since 2024-01-01 > sessions.ndjson
+    python -m core.database.transfer import sessions.ndjson --replace
+    python -m core.database.transfer snapshot /backups/auth_sessions.sqlite3
+"""
+import argparse
+import json
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import DateTime, select
+
+from .database import engine
+from .models import UserSession
+
+TABLE = UserSession.__table__
+COLUMNS = [column.name for column in TABLE.columns]
+TOKEN_COLUMNS = ("access_token", "refresh_token")
+DATETIME_COLUMNS = frozenset(column.name for column in TABLE.columns if isinstance(column.type, DateTime))
+FORMATS = ("rows", "columns")
+
+
+def page_query(after=None, chunk=1000, active=None, user_email=None, since=None, until=None,
+               tokens=False):
+    """One page of sessions after session id `after`; since/until filter on created_at."""
+    columns = [TABLE.c[name] for name in COLUMNS if tokens or name not in TOKEN_COLUMNS]
+    stmt = select(*columns).order_by(TABLE.c.session_id).limit(chunk)
+    if after is not None:
+        stmt = stmt.where(TABLE.c.session_id > after)
+    if active is not None:
+        stmt = stmt.where(TABLE.c.is_active == active)
+    if user_email:
+        stmt = stmt.where(TABLE.c.user_email == user_email)
+    if since:
+        stmt = stmt.where(TABLE.c.created_at >= since)
+    if until:
+        stmt = stmt.where(TABLE.c.created_at < until)
+    return stmt
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def encode_page(rows, fmt="rows"):
+    """NDJSON lines for one page of result rows."""
+    if fmt == "columns":
+        names = list(rows[0]._fields)
+        columns = {name: [_json_value(v) for v in values] for name, values in zip(names, zip(*rows))}
+        yield json.dumps(columns, separators=(",", ":")) + "\n"
+        return
+    for row in rows:
+        yield json.dumps({k: _json_value(v) for k, v in row._asdict().items()},
+                         separators=(",", ":")) + "\n"
+
+
+def export_sessions(bind=engine, fmt="rows", chunk=1000, **filters):
+    """NDJSON lines for every matching session, one page in memory at a time."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}")
+    after = None
+    while True:
+        with bind.connect() as conn:
+            rows = conn.execute(page_query(after, chunk, **filters)).all()
+        if not rows:
+            return
+        yield from encode_page(rows, fmt)
+        after = rows[-1].session_id
+
+
+async def export_sessions_async(bind, fmt="rows", chunk=1000, **filters):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}")
+    after = None
+    while True:
+        async with bind.connect() as conn:
+            rows = (await conn.execute(page_query(after, chunk, **filters))).all()
+        if not rows:
+            return
+        for line in encode_page(rows, fmt):
+            yield line
+        after = rows[-1].session_id
+
+
+def _row(data: dict) -> dict:
+    """The known columns present in `data`; absent ones are left to the database."""
+    if "session_id" not in data:
+        raise ValueError("session_id missing")
+    row = {}
+    for name in COLUMNS:
+        if name not in data:
+            continue
+        value = data[name]
+        if value is not None and name in DATETIME_COLUMNS:
+            value = datetime.fromisoformat(value)
+        row[name] = value
+    return row
+
+
+def decode_line(line) -> list[dict]:
+    """Insertable rows from one line of either format; blank lines give none."""
+    line = line.strip()
+    if not line:
+        return []
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError("each line must be a JSON object")
+    if isinstance(data.get("session_id"), list):
+        names = list(data)
+        return [_row(dict(zip(names, values))) for values in zip(*data.values())]
+    return [_row(data)]
+
+
+def insert_statement(bind, replace=False, columns=COLUMNS):
+    """
+    Batch insert that skips, or with `replace` overwrites, existing session
+    ids; only `columns` are overwritten.
+    """
+    if bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(TABLE)
+    if replace:
+        return stmt.on_conflict_do_update(
+            index_elements=[TABLE.c.session_id],
+            set_={name: stmt.excluded[name] for name in columns if name != "session_id"},
+        )
+    return stmt.on_conflict_do_nothing(index_elements=[TABLE.c.session_id])
+
+
+def _rows(lines):
+    for line in lines:
+        yield from decode_line(line)
+
+
+def _by_columns(chunk):
+    """Rows grouped by the columns they carry, each group one executemany."""
+    groups = {}
+    for row in chunk:
+        groups.setdefault(tuple(row), []).append(row)
+    return groups.items()
+
+
+def import_sessions(lines, bind=engine, batch=1000, replace=False, on_batch=None):
+    """
+    Insert sessions from NDJSON lines (an open file works); returns
+    (read, written). `on_batch(session_ids)` is called after each commit.
+    """
+    rows = _rows(lines)
+    read = written = 0
+    while True:
+        chunk = list(islice(rows, batch))
+        if not chunk:
+            return read, written
+        with bind.begin() as conn:
+            for columns, group in _by_columns(chunk):
+                written += max(conn.execute(insert_statement(bind, replace, columns), group).rowcount, 0)
+        read += len(chunk)
+        if on_batch:
+            on_batch([row["session_id"] for row in chunk])
+
+
+async def import_sessions_async(lines, bind, batch=1000, replace=False, on_batch=None):
+    """import_sessions() for an async iterator of lines, e.g. a streamed request body."""
+    read = written = 0
+    chunk = []
+
+    async def flush():
+        nonlocal read, written
+        async with bind.begin() as conn:
+            for columns, group in _by_columns(chunk):
+                written += max((await conn.execute(insert_statement(bind, replace, columns), group)).rowcount, 0)
+        read += len(chunk)
+        if on_batch:
+            on_batch([row["session_id"] for row in chunk])
+
+    async for line in lines:
+        chunk.extend(decode_line(line))
+        if len(chunk) >= batch:
+            await flush()
+            chunk = []
+    if chunk:
+        await flush()
+    return read, written
+
+
+async def body_lines(request):
+    """Lines of a streamed request body, without reading all of it first."""
+    pending = b""
+    async for data in request.stream():
+        pending += data
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def snapshot(dest: str, bind=engine, pages=-1, sleep=0.005):
+    """
+    Copy the live SQLite database to `dest` with the backup API.
+    - pages=-1 copies in one step under a single read transaction; in WAL
+      mode (SQLITE_PROFILE=tuned) writers carry on meanwhile
+    - pages=N copies N pages per step and releases the lock in between, for
+      rollback-journal databases; a write in between restarts the copy
+    """
+    if bind.dialect.name != "sqlite":
+        raise ValueError("snapshot needs SQLite, use the server's own backup tools")
+    raw = bind.raw_connection()
+    try:
+        target = sqlite3.connect(dest)
+        try:
+            raw.driver_connection.backup(target, pages=pages, sleep=sleep)
+        finally:
+            target.close()
+    finally:
+        raw.close()
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="sessions as NDJSON on stdout or --output")
+    export.add_argument("--output", help="file to write instead of stdout")
+    export.add_argument("--format", choices=FORMATS, default="rows")
+    export.add_argument("--chunk", type=int, default=1000)
+    state = export.add_mutually_exclusive_group()
+    state.add_argument("--active", dest="active", action="store_true", default=None)
+    state.add_argument("--inactive", dest="active", action="store_false")
+    export.add_argument("--user", dest="user_email", help="only this user_email")
+    export.add_argument("--since", type=datetime.fromisoformat, help="created_at from (ISO, UTC)")
+    export.add_argument("--until", type=datetime.fromisoformat, help="created_at before (ISO, UTC)")
+    export.add_argument("--tokens", action="store_true",
+                        help="include access/refresh tokens, decrypted")
+
+    load = commands.add_parser("import", help="sessions from NDJSON of either format")
+    load.add_argument("input", nargs="?", default="-", help="file, or - for stdin")
+    load.add_argument("--batch", type=int, default=1000)
+    load.add_argument("--replace", action="store_true", help="overwrite existing session ids")
+
+    snap = commands.add_parser("snapshot", help="online copy of the SQLite database")
+    snap.add_argument("dest")
+    snap.add_argument("--pages", type=int, default=-1, help="pages per step, -1 for one step")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    start = time.perf_counter()
+
+    if args.command == "export":
+        filters = {"active": args.active, "user_email": args.user_email,
+                   "since": args.since, "until": args.until, "tokens": args.tokens}
+        out = open(args.output, "w") if args.output else sys.stdout
+        try:
+            out.writelines(export_sessions(fmt=args.format, chunk=args.chunk, **filters))
+        finally:
+            if args.output:
+                out.close()
+        print(f"Exported in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    elif args.command == "import":
+        source = sys.stdin if args.input == "-" else open(args.input)
+        with source:
+            read, written = import_sessions(source, batch=args.batch, replace=args.replace)
+        # running workers keep cached state for up to SESSION_CACHE_TTL
+        print(f"Read {read} sessions, wrote {written} in {time.perf_counter() - start:.1f}s",
+              file=sys.stderr)
+
+    elif args.command == "snapshot":
+        snapshot(args.dest, pages=args.pages)
+        print(f"Snapshot written to {args.dest} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
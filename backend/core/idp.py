@@ -0,0 +1,294 @@
+"""
+Outbound calls to the identity provider.
+
+- one pooled keep-alive client per worker (async for request handlers, sync
+  for the JWKS refresher thread), connect/read timeouts from Config
+- at most IDP_MAX_CONCURRENCY calls in flight; callers wait for a slot up
+  to IDP_QUEUE_TIMEOUT
+- connection errors and 429/502/503/504 are retried with full-jitter backoff;
+  POSTs (token requests aren't idempotent) only when the provider can't
+  have acted on them: no connection made, or 429/503
+- a circuit breaker fails calls fast while the provider is down
+
+Calls that can't be made answer 503 (HTTPException) instead of hanging the
+request.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import httpx
+from fastapi import HTTPException, status
+
+from .config import Config
+from .metrics import observe_idp, registry
+
+config = Config()
+log = logging.getLogger(__name__)
+
+TOKEN_URL = config.IDP_TOKEN_URL
+RETRY_STATUSES = {429, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+# a refresh token used by a request the provider did process may already be rotated
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+UNPROCESSED_STATUSES = {429, 503}
+
+# one pooled client shared by the whole app, opened/closed in the lifespan
+_client: httpx.AsyncClient | None = None
+_slots: asyncio.Semaphore | None = None
+# the jwks refresher and sync handlers run on threads
+_sync_client: httpx.Client | None = None
+_sync_slots = threading.BoundedSemaphore(config.IDP_MAX_CONCURRENCY)
+_sync_lock = threading.Lock()
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures; while open calls fail at
+    once. Every `cooldown` seconds one trial call goes through (half-open):
+    success closes the breaker, failure keeps it open.
+    """
+
+    def __init__(self, threshold=5, cooldown=30, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.failures < self.threshold:
+            return "closed"
+        return "open" if self.clock() < self._open_until else "half_open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.failures < self.threshold:
+                return True
+            now = self.clock()
+            if now < self._open_until:
+                return False
+            # half-open: this call is the trial, everyone else waits another cooldown
+            self._open_until = now + self.cooldown
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures == self.threshold:
+                self.opened += 1
+                log.warning("identity provider circuit open", extra={"failures": self.failures})
+            if self.failures >= self.threshold:
+                self._open_until = self.clock() + self.cooldown
+
+
+breaker = CircuitBreaker(config.IDP_BREAKER_THRESHOLD, config.IDP_BREAKER_COOLDOWN)
+
+
+def _timeout():
+    return httpx.Timeout(config.IDP_READ_TIMEOUT, connect=config.IDP_CONNECT_TIMEOUT)
+
+
+def _limits():
+    return httpx.Limits(max_connections=config.IDP_MAX_CONNECTIONS,
+                        max_keepalive_connections=config.IDP_MAX_KEEPALIVE)
+
+
+async def start():
+    global _client, _slots
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=_timeout(), limits=_limits())
+    # bound to the running loop, so made here rather than at import
+    _slots = asyncio.Semaphore(config.IDP_MAX_CONCURRENCY)
+
+
+async def close():
+    global _client, _sync_client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    with _sync_lock:
+        if _sync_client is not None:
+            _sync_client.close()
+            _sync_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    if _client is None:
+        raise RuntimeError("IdP client not started")
+    return _client
+
+
+def get_sync_client() -> httpx.Client:
+    global _sync_client
+    with _sync_lock:
+        if _sync_client is None:
+            _sync_client = httpx.Client(timeout=_timeout(), limits=_limits())
+        return _sync_client
+
+
+def unavailable(reason):
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=f"Identity provider unavailable: {reason}",
+        headers={"Retry-After": str(int(config.IDP_BREAKER_COOLDOWN))},
+    )
+
+
+def _backoff(attempt):
+    return random.uniform(0, min(config.IDP_RETRY_MAX_DELAY, config.IDP_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _settle(res):
+    """Feeds the breaker; True if the response is worth retrying."""
+    if res.status_code >= 500:
+        breaker.failure()
+    else:
+        # 4xx (e.g. invalid_grant) means the provider is up
+        breaker.success()
+    return res.status_code in RETRY_STATUSES
+
+
+def _may_retry(method, failure) -> bool:
+    """Whether a failed call (transport error or retry status) can be sent again."""
+    if method.upper() in IDEMPOTENT_METHODS:
+        return True
+    if isinstance(failure, Exception):
+        return isinstance(failure, UNSENT_ERRORS)
+    return failure in UNPROCESSED_STATUSES
+
+
+async def request(method, url, **kwargs) -> httpx.Response:
+    client = get_http_client()
+    error = None
+    for attempt in range(config.IDP_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(_backoff(attempt - 1))
+        try:
+            await asyncio.wait_for(_slots.acquire(), config.IDP_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise unavailable("too many calls in flight")
+        try:
+            if not breaker.allow():
+                raise unavailable("circuit open")
+            res = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            breaker.failure()
+            error = type(e).__name__
+            if not _may_retry(method, e):
+                break
+            continue
+        finally:
+            _slots.release()
+        if not _settle(res):
+            return res
+        error = f"HTTP {res.status_code}"
+        if not _may_retry(method, res.status_code):
+            break
+    log.warning("identity provider call failed", extra={"url": url, "error": error})
+    raise unavailable(error)
+
+
+def request_sync(method, url, **kwargs) -> httpx.Response:
+    """Blocking twin of request(), for threads."""
+    client = get_sync_client()
+    error = None
+    for attempt in range(config.IDP_RETRIES + 1):
+        if attempt:
+            time.sleep(_backoff(attempt - 1))
+        if not _sync_slots.acquire(timeout=config.IDP_QUEUE_TIMEOUT):
+            raise unavailable("too many calls in flight")
+        try:
+            if not breaker.allow():
+                raise unavailable("circuit open")
+            res = client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            breaker.failure()
+            error = type(e).__name__
+            if not _may_retry(method, e):
+                break
+            continue
+        finally:
+            _sync_slots.release()
+        if not _settle(res):
+            return res
+        error = f"HTTP {res.status_code}"
+        if not _may_retry(method, res.status_code):
+            break
+    log.warning("identity provider call failed", extra={"url": url, "error": error})
+    raise unavailable(error)
+
+
+def token_error(res):
+    """The provider's refusal of a code: 401 for bad client credentials, 400 otherwise."""
+    try:
+        body = res.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        body = {}
+    reason = body.get("error") or f"HTTP {res.status_code}"
+    if body.get("error_description"):
+        reason += f": {body['error_description']}"
+    return HTTPException(
+        status_code=(status.HTTP_401_UNAUTHORIZED if res.status_code == 401
+                     else status.HTTP_400_BAD_REQUEST),
+        detail=f"Identity provider refused the code exchange: {reason}",
+    )
+
+
+def authorize_url(redirect_uri: str) -> str:
+    return str(httpx.URL(config.IDP_AUTHORIZE_URL, params={
+        "response_type": "code",
+        "client_id": config.CLIENT_ID,
+        "redirect_uri": redirect_uri,
+        "scope": "offline_access openid profile email",
+        "audience": config.API_AUDIENCE,
+    }))
+
+
+def _refresh_payload(refresh_token):
+    return {
+        "grant_type": "refresh_token",
+        "client_id": config.CLIENT_ID,
+        "client_secret": config.CLIENT_SECRET,
+        "refresh_token": refresh_token,
+    }
+
+
+@observe_idp("authorization_code")
+async def exchange_code(code: str) -> dict:
+    payload = {
+        "grant_type": "authorization_code",
+        "client_id": config.CLIENT_ID,
+        "client_secret": config.CLIENT_SECRET,
+        "code": code,
+        "scope": "offline_access openid profile email",
+        "redirect_uri": f"{config.BACKEND_URI}/token",
+    }
+    res = await request("POST", TOKEN_URL, data=payload)
+    if res.status_code != 200:
+        raise token_error(res)
+    return res.json()
+
+
+@observe_idp("refresh_token")
+async def refresh_tokens(refresh_token: str) -> httpx.Response:
+    return await request("POST", TOKEN_URL, data=_refresh_payload(refresh_token))
+
+
+def refresh_tokens_sync(refresh_token: str) -> httpx.Response:
+    return request_sync("POST", TOKEN_URL, data=_refresh_payload(refresh_token))
+
+
+registry.gauge("idp_circuit_open", "1 while calls to the identity provider fail fast",
+               lambda: 0 if breaker.state == "closed" else 1)
@@ -0,0 +1,180 @@
+import json
+import logging
+import re
+import threading
+import time
+
+from jose import jwk
+
+from . import idp
+from .background import PeriodicTask
+from .metrics import IDP_LATENCY
+
+log = logging.getLogger(__name__)
+
+MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+
+class JWKSKeyStore:
+    """
+    kid -> constructed public key, so validate_token never does a network
+    round trip for a key it has already seen.
+
+    - keys are refreshed in the background every `ttl` seconds, or whatever
+      the provider's Cache-Control max-age says
+    - an unknown kid triggers one fetch shared by all concurrent callers
+    - kids that are still unknown after a fetch are negatively cached, at
+      most `max_missing` of them (kid comes from the untrusted token header)
+    """
+
+    def __init__(self, url=None, ttl=600, negative_ttl=60, min_refresh_interval=10, timeout=5,
+                 max_missing=1024):
+        self.url = url
+        self.default_ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_missing = max_missing
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+
+        self._keys = {}
+        self._missing = {}
+        self._ttl = ttl
+        self._last_fetch = 0.0
+        self._last_ok = False
+        self._lock = threading.Lock()
+        self._inflight = None
+        self._refresher = PeriodicTask(self.refresh, lambda: self._ttl,
+                                       name="jwks-refresh", run_first=True)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        store = cls(url=None, **kwargs)
+        store.load_file(path)
+        return store
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, kid):
+        return kid in self._keys
+
+    def load_keys(self, jwks: dict):
+        keys = {}
+        for key in jwks.get("keys", []):
+            if "kid" not in key or key.get("use", "sig") != "sig":
+                continue
+            keys[key["kid"]] = jwk.construct(key, key.get("alg", "RS256"))
+
+        # swap the whole mapping so readers never see a half-built store
+        with self._lock:
+            self._keys = keys
+            self._missing = {kid: t for kid, t in self._missing.items() if kid not in keys}
+        return len(keys)
+
+    def load_file(self, path):
+        with open(path) as f:
+            return self.load_keys(json.load(f))
+
+    def _ttl_from_headers(self, headers):
+        cache_control = headers.get("Cache-Control", "").lower()
+        if "no-store" in cache_control or "no-cache" in cache_control:
+            return self.min_refresh_interval
+        match = MAX_AGE_RE.search(cache_control)
+        if match:
+            return max(int(match.group(1)), self.min_refresh_interval)
+        return self.default_ttl
+
+    def _fetch(self):
+        self.fetches += 1
+        res = idp.request_sync("GET", self.url, timeout=self.timeout)
+        res.raise_for_status()
+        self.load_keys(res.json())
+        self._ttl = self._ttl_from_headers(res.headers)
+
+    def refresh(self, force=True) -> bool:
+        """
+        Fetch the JWKS once; concurrent callers wait on the in-flight fetch.
+        True if the keys were fetched, False if the fetch failed or was
+        skipped for being within `min_refresh_interval` of the last one.
+        """
+        if not self.url:
+            return False
+        with self._lock:
+            event = self._inflight
+            leader = event is None
+            if leader:
+                if not force and time.monotonic() - self._last_fetch < self.min_refresh_interval:
+                    return False
+                event = self._inflight = threading.Event()
+
+        if not leader:
+            return event.wait(self.timeout) and self._last_ok
+
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            self._fetch()
+            outcome = "ok"
+        except Exception as e:
+            # keep serving the keys we already have
+            log.warning("jwks refresh failed: %s", e)
+        finally:
+            IDP_LATENCY.observe(time.perf_counter() - start, "jwks", outcome)
+            with self._lock:
+                self._last_fetch = time.monotonic()
+                self._last_ok = outcome == "ok"
+                self._inflight = None
+            event.set()
+        return self._last_ok
+
+    def _remember_missing(self, kid):
+        now = time.monotonic()
+        with self._lock:
+            missing = self._missing
+            missing.pop(kid, None)
+            # one negative_ttl for all, so insertion order is expiry order:
+            # expired entries and, past max_missing, the oldest go from the front
+            while missing:
+                oldest = next(iter(missing))
+                if missing[oldest] > now and len(missing) < self.max_missing:
+                    break
+                del missing[oldest]
+            missing[kid] = now + self.negative_ttl
+
+    def get_key(self, kid: str):
+        key = self._keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+
+        self.misses += 1
+        if self._missing.get(kid, 0) > time.monotonic():
+            return None
+
+        fetched = self.refresh(force=False)
+        key = self._keys.get(kid)
+        if key is None and fetched:
+            # only a kid the provider really doesn't have; a skipped refresh proves nothing
+            self._remember_missing(kid)
+        return key
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "keys": len(self._keys),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetches": self.fetches,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def start(self):
+        if self.url:
+            self._refresher.start()
+
+    def stop(self):
+        self._refresher.stop()
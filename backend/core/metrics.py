@@ -0,0 +1,278 @@
+"""
+Prometheus text-format metrics without the client library.
+
+- Counter / Histogram are updated on the hot path: a dict lookup and a
+  lock-protected add, no allocation once a label set has been seen
+- Gauge reads a callback at scrape time, so cache sizes, pending logins and
+  active sessions cost nothing between scrapes; CounterFunc does the same
+  for totals a component already counts
+- MetricsMiddleware times every request and the DB queries it ran
+"""
+import bisect
+import contextvars
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self):
+        return []
+
+    def render(self):
+        return self.header() + self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in values]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[index] += 1
+            row[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(k, list(v)) for k, v in self._values.items()]
+        lines = []
+        bounds = self.buckets + (float("inf"),)
+        names = self.labelnames + ("le",)
+        for labels, row in values:
+            cumulative = 0
+            for bound, count in zip(bounds, row):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (_number(float(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(row[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Gauge(Metric):
+    """Value read from `func` at scrape time; func may return a number or {labels: number}."""
+    kind = "gauge"
+
+    def __init__(self, name, help, func, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.func = func
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception as e:
+            log.warning("metric %s failed: %s", self.name, e)
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{_labels(self.labelnames, k if isinstance(k, tuple) else (k,))} {_number(v)}"
+                for k, v in value.items()]
+
+
+class CounterFunc(Gauge):
+    """Counter read from `func` at scrape time, for totals an object already keeps."""
+    kind = "counter"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, func, labelnames=()):
+        return self.register(Gauge(name, help, func, labelnames))
+
+    def counter_func(self, name, help, func, labelnames=()):
+        return self.register(CounterFunc(name, help, func, labelnames))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_LATENCY = registry.histogram(
+    "http_request_duration_seconds", "Request latency by route", ("method", "route", "status"))
+DB_QUERIES = registry.counter(
+    "db_queries_total", "SQL statements executed")
+DB_QUERY_SECONDS = registry.counter(
+    "db_query_seconds_total", "Time spent executing SQL statements")
+DB_QUERIES_PER_REQUEST = registry.histogram(
+    "db_queries_per_request", "SQL statements per request", ("route",), buckets=COUNT_BUCKETS)
+DB_SECONDS_PER_REQUEST = registry.histogram(
+    "db_seconds_per_request", "Time spent in SQL per request", ("route",))
+RATE_LIMITED = registry.counter(
+    "rate_limited_total", "Requests rejected with 429", ("limiter",))
+IDP_LATENCY = registry.histogram(
+    "idp_request_duration_seconds", "Outbound identity provider call latency", ("call", "outcome"))
+
+# [queries, seconds] for the request being handled, shared with threads and run_sync
+_request_db = contextvars.ContextVar("request_db", default=None)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_start
+    DB_QUERIES.inc()
+    DB_QUERY_SECONDS.inc(amount=elapsed)
+    current = _request_db.get()
+    if current is not None:
+        current[0] += 1
+        current[1] += elapsed
+
+
+def instrument_engine(engine):
+    """Count and time every statement run through `engine` (sync or async)."""
+    engine = getattr(engine, "sync_engine", engine)
+    event.listen(engine, "before_cursor_execute", _before_execute)
+    event.listen(engine, "after_cursor_execute", _after_execute)
+
+
+def observe_idp(call):
+    """Decorator timing an async IdP call, outcome is ok/error by exception."""
+    def decorator(func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                IDP_LATENCY.observe(time.perf_counter() - start, call, outcome)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware, cheaper than BaseHTTPMiddleware on every request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        db = [0, 0.0]
+        token = _request_db.set(db)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_db.reset(token)
+            route = scope.get("route")
+            # unmatched paths share one label so scanners can't blow up cardinality
+            path = route.path if route is not None else "unmatched"
+            HTTP_LATENCY.observe(elapsed, scope["method"], path, status[0])
+            DB_QUERIES_PER_REQUEST.observe(db[0], path)
+            DB_SECONDS_PER_REQUEST.observe(db[1], path)
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from sqlalchemy import delete, func, select
+
+from .database.database import SessionLocal
+from .database.models import PendingLogin
+
+
+class PendingLoginStore(ABC):
+    """
+    login_id -> pending login stashed by /token until /session/check.
+    Entries expire after `ttl` seconds, expired ones are removed by `reap`.
+    """
+
+    def __init__(self, ttl=600, max_size=10000, clock=time.time):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.reaped = 0
+        self.evicted = 0
+
+    @abstractmethod
+    def put(self, login_id: str, data: dict):
+        ...
+
+    @abstractmethod
+    def get(self, login_id: str):
+        ...
+
+    @abstractmethod
+    def pop(self, login_id: str):
+        ...
+
+    @abstractmethod
+    def reap(self) -> int:
+        ...
+
+    @abstractmethod
+    def __len__(self):
+        ...
+
+    def __contains__(self, login_id):
+        return self.get(login_id) is not None
+
+    # for the async request path; stores doing I/O run it on a thread so the
+    # event loop never waits on a database lock
+    async def put_async(self, login_id: str, data: dict):
+        self.put(login_id, data)
+
+    async def get_async(self, login_id: str):
+        return self.get(login_id)
+
+    async def pop_async(self, login_id: str):
+        return self.pop(login_id)
+
+    def _count(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        return {
+            "backend": type(self).__name__,
+            "size": len(self),
+            "puts": self.puts,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reaped": self.reaped,
+            "evicted": self.evicted,
+        }
+
+
+class MemoryPendingLoginStore(PendingLoginStore):
+    """In-process store, only correct with a single worker."""
+
+    def __init__(self, ttl=600, max_size=10000, clock=time.time):
+        super().__init__(ttl, max_size, clock)
+        # insertion order == expiry order since every entry gets the same ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, login_id, data):
+        with self._lock:
+            self._data[login_id] = (self.clock() + self.ttl, data)
+            self._data.move_to_end(login_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evicted += 1
+            self.puts += 1
+
+    def get(self, login_id):
+        entry = self._data.get(login_id)
+        if entry is None or entry[0] <= self.clock():
+            return self._count(None)
+        return self._count(entry[1])
+
+    def pop(self, login_id):
+        with self._lock:
+            entry = self._data.pop(login_id, None)
+        if entry is None or entry[0] <= self.clock():
+            return self._count(None)
+        return self._count(entry[1])
+
+    def reap(self):
+        now = self.clock()
+        reaped = 0
+        with self._lock:
+            while self._data:
+                login_id, (expires_at, _) = next(iter(self._data.items()))
+                if expires_at > now:
+                    break
+                del self._data[login_id]
+                reaped += 1
+        self.reaped += reaped
+        return reaped
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DatabasePendingLoginStore(PendingLoginStore):
+    """Shared store in the pending_logins table, safe across workers and nodes."""
+
+    def __init__(self, ttl=600, max_size=10000, clock=time.time, session_factory=SessionLocal):
+        super().__init__(ttl, max_size, clock)
+        self.session_factory = session_factory
+
+    async def put_async(self, login_id, data):
+        await asyncio.to_thread(self.put, login_id, data)
+
+    async def get_async(self, login_id):
+        return await asyncio.to_thread(self.get, login_id)
+
+    async def pop_async(self, login_id):
+        return await asyncio.to_thread(self.pop, login_id)
+
+    def put(self, login_id, data):
+        with self.session_factory() as db:
+            db.merge(PendingLogin(login_id=login_id,
+                                  data=json.dumps(data),
+                                  expires_at=self.clock() + self.ttl))
+            db.commit()
+        self.puts += 1
+
+    def get(self, login_id):
+        with self.session_factory() as db:
+            data = db.execute(
+                select(PendingLogin.data).where(PendingLogin.login_id == login_id,
+                                                PendingLogin.expires_at > self.clock())
+            ).scalar()
+        return self._count(json.loads(data) if data else None)
+
+    def pop(self, login_id):
+        # delete ... returning, so only one worker can consume a login
+        with self.session_factory() as db:
+            row = db.execute(
+                delete(PendingLogin)
+                .where(PendingLogin.login_id == login_id)
+                .returning(PendingLogin.data, PendingLogin.expires_at)
+            ).first()
+            db.commit()
+        # data is None when it can't be decrypted any more
+        if row is None or row.data is None or row.expires_at <= self.clock():
+            return self._count(None)
+        return self._count(json.loads(row.data))
+
+    def reap(self):
+        with self.session_factory() as db:
+            reaped = db.execute(
+                delete(PendingLogin).where(PendingLogin.expires_at <= self.clock())
+            ).rowcount
+            overflow = db.execute(select(func.count()).select_from(PendingLogin)).scalar() - self.max_size
+            if overflow > 0:
+                oldest = (select(PendingLogin.login_id)
+                          .order_by(PendingLogin.expires_at)
+                          .limit(overflow))
+                db.execute(delete(PendingLogin).where(PendingLogin.login_id.in_(oldest)))
+                self.evicted += overflow
+            db.commit()
+        self.reaped += reaped
+        return reaped
+
+    def __len__(self):
+        with self.session_factory() as db:
+            return db.execute(select(func.count()).select_from(PendingLogin)).scalar()
+
+
+def create_pending_store(config) -> PendingLoginStore:
+    backends = {
+        "memory": MemoryPendingLoginStore,
+        "database": DatabasePendingLoginStore,
+    }
+    if config.PENDING_LOGIN_BACKEND not in backends:
+        raise ValueError(f"Unknown PENDING_LOGIN_BACKEND {config.PENDING_LOGIN_BACKEND!r}")
+    return backends[config.PENDING_LOGIN_BACKEND](
+        ttl=config.PENDING_LOGIN_TTL,
+        max_size=config.PENDING_LOGIN_MAX,
+    )
@@ -0,0 +1,200 @@
+"""
+Admission control for the login and force-logout endpoints.
+
+Token buckets kept as GCRA: per key only the "theoretical arrival time" is
+stored, one float. `rate` requests per second are sustained and up to
+`burst` can come back to back. A key whose arrival time is in the past has a
+full bucket, so such entries can be dropped at any time without changing a
+decision.
+"""
+import asyncio
+import math
+from abc import ABC, abstractmethod
+import threading
+import time
+from itertools import islice
+
+from fastapi import HTTPException, Request, status
+from sqlalchemy import case, delete, func, select
+
+from .database.database import SessionLocal, engine
+from .database.models import RateLimit
+from .metrics import RATE_LIMITED
+
+
+class RateLimiter(ABC):
+    """hit(key) is 0 when the request may go ahead, otherwise the seconds until it may."""
+
+    def __init__(self, name, rate, burst, max_keys=100000, clock=time.time):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.emission = 1.0 / rate if rate > 0 else 0.0
+        self.allowed = 0
+        self.limited = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    @abstractmethod
+    def hit(self, key: str) -> float:
+        ...
+
+    @abstractmethod
+    def reap(self) -> int:
+        ...
+
+    @abstractmethod
+    def __len__(self):
+        ...
+
+    async def hit_async(self, key: str) -> float:
+        return self.hit(key)
+
+    def _count(self, retry_after):
+        if retry_after:
+            self.limited += 1
+            RATE_LIMITED.inc(self.name)
+        else:
+            self.allowed += 1
+        return retry_after
+
+    def stats(self):
+        return {
+            "backend": type(self).__name__,
+            "keys": len(self),
+            "allowed": self.allowed,
+            "limited": self.limited,
+        }
+
+
+class MemoryRateLimiter(RateLimiter):
+    """
+    In-process buckets, per worker.
+    - key -> arrival time in a plain dict, re-inserted on every hit so the
+      dict stays ordered by last use
+    - past `max_keys` the least recently used tenth is dropped (those keys
+      come back with a full bucket)
+    """
+
+    def __init__(self, name, rate, burst, max_keys=100000, clock=time.time):
+        super().__init__(name, rate, burst, max_keys, clock)
+        self._tat = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key):
+        now = self.clock()
+        with self._lock:
+            tat = max(self._tat.pop(key, now), now) + self.emission
+            allow_at = tat - self.burst * self.emission
+            if allow_at > now:
+                # limited: keep the old arrival time
+                self._tat[key] = tat - self.emission
+                return self._count(allow_at - now)
+            self._tat[key] = tat
+            if len(self._tat) > self.max_keys:
+                self._evict()
+        return self._count(0)
+
+    def _evict(self):
+        # a tenth at a time: finding the oldest key walks past the slots freed
+        # by re-insertion, once per batch instead of once per hit
+        for key in list(islice(self._tat, max(self.max_keys // 10, 1))):
+            del self._tat[key]
+
+    def reap(self):
+        now = self.clock()
+        with self._lock:
+            idle = [key for key, tat in self._tat.items() if tat <= now]
+            for key in idle:
+                del self._tat[key]
+        return len(idle)
+
+    def __len__(self):
+        return len(self._tat)
+
+
+class DatabaseRateLimiter(RateLimiter):
+    """
+    Buckets in the rate_limits table, shared by every worker.
+    One upsert per hit, so this costs a write transaction per request.
+    """
+
+    def __init__(self, name, rate, burst, max_keys=100000, clock=time.time, session_factory=SessionLocal):
+        super().__init__(name, rate, burst, max_keys, clock)
+        self.session_factory = session_factory
+        if engine.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        self._insert = insert
+
+    async def hit_async(self, key):
+        return await asyncio.to_thread(self.hit, key)
+
+    def hit(self, key):
+        key = f"{self.name}:{key}"
+        now = self.clock()
+        table = RateLimit.__table__
+        tat = case((table.c.tat > now, table.c.tat), else_=now) + self.emission
+        stmt = self._insert(table).values(key=key, tat=now + self.emission)
+        # the conditional upsert decides, so concurrent workers can't both take the last token
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={"tat": tat},
+            where=tat - self.burst * self.emission <= now,
+        ).returning(table.c.tat)
+        with self.session_factory() as db:
+            admitted = db.execute(stmt).first()
+            if admitted is None:
+                current = db.execute(select(table.c.tat).where(table.c.key == key)).scalar()
+            db.commit()
+        if admitted is not None:
+            return self._count(0)
+        return self._count(max(current + self.emission - self.burst * self.emission - now, 0.001))
+
+    def reap(self):
+        now = self.clock()
+        with self.session_factory() as db:
+            reaped = db.execute(delete(RateLimit).where(RateLimit.tat <= now)).rowcount
+            db.commit()
+        return reaped
+
+    def __len__(self):
+        with self.session_factory() as db:
+            return db.execute(select(func.count()).select_from(RateLimit)).scalar()
+
+
+def create_rate_limiter(config, name, rate, burst) -> RateLimiter:
+    backends = {
+        "memory": MemoryRateLimiter,
+        "database": DatabaseRateLimiter,
+    }
+    if config.RATE_LIMIT_BACKEND not in backends:
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND {config.RATE_LIMIT_BACKEND!r}")
+    return backends[config.RATE_LIMIT_BACKEND](name, rate, burst, max_keys=config.RATE_LIMIT_MAX_KEYS)
+
+
+def too_many_requests(retry_after):
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests",
+        headers={"Retry-After": str(math.ceil(retry_after))},
+    )
+
+
+async def enforce(limiter: RateLimiter, key: str):
+    if limiter.enabled:
+        retry_after = await limiter.hit_async(key)
+        if retry_after:
+            raise too_many_requests(retry_after)
+
+
+def limit_by_ip(limiter: RateLimiter):
+    """Route dependency: one hit per request against the client's address."""
+    async def dependency(request: Request):
+        await enforce(limiter, request.client.host if request.client else "unknown")
+    return dependency
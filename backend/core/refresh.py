@@ -0,0 +1,144 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from jose import jwt
+from sqlalchemy.orm import undefer_group
+
+from .database.database import AsyncSessionLocal
+from .database.models import UserSession
+
+log = logging.getLogger(__name__)
+
+
+def token_exp(access_token):
+    """exp claim of an access token, read without verifying it."""
+    try:
+        return jwt.get_unverified_claims(access_token).get("exp")
+    except Exception:
+        return None
+
+
+class TokenRefresher:
+    """
+    Access token refresh for stored sessions.
+    - `refresh` is single-flight per session: concurrent callers share one
+      call to the token endpoint and one write of the new tokens
+    - `track` schedules a background refresh `lead_time` seconds before the
+      token expires, so requests on a used session never wait for it
+    - a row whose token is already fresh, e.g. refreshed by another worker,
+      isn't refreshed again
+    Proactive refreshes are not rescheduled; the next request on the session
+    tracks the new token again, so idle sessions stop being refreshed.
+    """
+
+    def __init__(self, refresh_tokens, on_refreshed=None, lead_time=60, concurrency=10,
+                 session_factory=AsyncSessionLocal):
+        self.refresh_tokens = refresh_tokens
+        self.on_refreshed = on_refreshed
+        self.lead_time = lead_time
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self.refreshes = 0
+        self.shared = 0
+        self._inflight = {}
+        self._heap = []
+        self._scheduled = {}
+        # asyncio primitives are created in start(), inside the serving loop
+        self._semaphore = None
+        self._wakeup = None
+        self._task = None
+
+    async def _do_refresh(self, session_id):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore, self.session_factory() as db:
+            session = await db.get(UserSession, session_id, options=[undefer_group("tokens")])
+            if session is None or not session.is_active:
+                return None
+
+            if session.access_token_exp is not None and session.access_token_exp > time.time() + self.lead_time:
+                # another worker refreshed it already; only our cached expiry is stale
+                access_token = session.access_token
+            else:
+                tokens = await self.refresh_tokens(session.refresh_token)
+                access_token = session.access_token = tokens["access_token"]
+                session.access_token_exp = token_exp(access_token)
+                if "refresh_token" in tokens:
+                    session.refresh_token = tokens["refresh_token"]
+                await db.commit()
+                self.refreshes += 1
+
+        if self.on_refreshed:
+            self.on_refreshed(session_id)
+        return access_token
+
+    async def refresh(self, session_id: str):
+        """Refresh the session's tokens, joining a refresh already in flight."""
+        task = self._inflight.get(session_id)
+        if task is None:
+            task = asyncio.ensure_future(self._do_refresh(session_id))
+            self._inflight[session_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(session_id, None))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def track(self, session_id: str, exp):
+        if exp is None:
+            return
+        due = exp - self.lead_time
+        if self._scheduled.get(session_id) == due:
+            return
+        self._scheduled[session_id] = due
+        heapq.heappush(self._heap, (due, session_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _refresh_due(self, session_id):
+        try:
+            await self.refresh(session_id)
+        except Exception as e:
+            log.warning("proactive refresh failed: %s", e)
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due, session_id = heapq.heappop(self._heap)
+                # skip entries superseded by a later track()
+                if self._scheduled.get(session_id) != due:
+                    continue
+                del self._scheduled[session_id]
+                asyncio.ensure_future(self._refresh_due(session_id))
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "refreshes": self.refreshes,
+            "shared": self.shared,
+            "inflight": len(self._inflight),
+            "scheduled": len(self._scheduled),
+        }
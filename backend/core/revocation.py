@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import time
+
+from sqlalchemy import select
+
+from .database.database import AsyncSessionLocal
+from .database.models import UserSession
+from .session_cache import session_state
+
+log = logging.getLogger(__name__)
+
+
+def revocation(state, now):
+    """
+    Why a session is no longer valid, shaped like /session/validate's answer; None while valid.
+    `now` is epoch seconds, compared with the record's expiry as is.
+    """
+    if state is None:
+        return {"valid": False, "reason": "session_not_found"}
+    if state.is_active and state.expires > now:
+        return None
+    if not state.is_active and state.closed_reason == "force_logout":
+        return {
+            "valid": False,
+            "reason": "force_logged_out",
+            "details": {
+                "logged_out_by": state["force_logged_by"],
+                "logged_out_at": state["force_logged_at"].isoformat(),
+                "message": state["force_logout_message"]
+            }
+        }
+    return {"valid": False, "reason": "session_expired"}
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class RevocationHub:
+    """
+    session_id -> futures of the open /session/events streams for it.
+
+    - subscribed to the invalidation channel, so a logout on any worker
+      reaches the streams held by this one
+    - invalidated sessions are re-read once for all their streams and only
+      revoked ones get an event (token refreshes invalidate too)
+    - a stream costs one future and one dict entry, there is no task or
+      queue per connection, so a worker can hold tens of thousands
+    """
+
+    def __init__(self, heartbeat=25, chunk_size=500, session_factory=AsyncSessionLocal):
+        self.heartbeat = heartbeat
+        self.chunk_size = chunk_size
+        self.session_factory = session_factory
+        self.revoked = 0
+        self._streams = {}
+        self._loop = None
+        self._checks = set()
+
+    def __len__(self):
+        return sum(len(futures) for futures in self._streams.values())
+
+    async def load_states(self, session_ids):
+        states = {}
+        async with self.session_factory() as db:
+            for i in range(0, len(session_ids), self.chunk_size):
+                rows = await db.execute(
+                    select(UserSession).where(UserSession.session_id.in_(session_ids[i:i + self.chunk_size]))
+                )
+                for session in rows.scalars():
+                    states[session.session_id] = session_state(session)
+        return states
+
+    def subscribe(self, session_id):
+        future = self._loop.create_future()
+        self._streams.setdefault(session_id, set()).add(future)
+        return future
+
+    def unsubscribe(self, session_id, future):
+        futures = self._streams.get(session_id)
+        if futures is not None:
+            futures.discard(future)
+            if not futures:
+                del self._streams[session_id]
+
+    def publish(self, session_id, event):
+        for future in self._streams.pop(session_id, ()):
+            if not future.done():
+                future.set_result(event)
+                self.revoked += 1
+
+    def on_invalidated(self, session_ids):
+        """Invalidation channel callback, may run on any thread."""
+        loop = self._loop
+        if loop is None:
+            return
+        watched = [sid for sid in session_ids if sid in self._streams]
+        if watched:
+            loop.call_soon_threadsafe(self._start_check, watched)
+
+    def _start_check(self, session_ids):
+        task = self._loop.create_task(self._check(session_ids))
+        self._checks.add(task)
+        task.add_done_callback(self._checks.discard)
+
+    async def _check(self, session_ids):
+        try:
+            states = await self.load_states(session_ids)
+        except Exception:
+            log.exception("loading revoked sessions failed")
+            return
+        now = time.time()
+        for session_id in session_ids:
+            event = revocation(states.get(session_id), now)
+            if event is not None:
+                self.publish(session_id, event)
+
+    async def stream(self, session_id):
+        """SSE body: the current state, heartbeats, then one `revoked` event."""
+        # subscribe before reading, so a logout in between isn't missed
+        future = self.subscribe(session_id)
+        try:
+            state = (await self.load_states([session_id])).get(session_id)
+            event = revocation(state, time.time())
+            if event is not None:
+                yield sse("revoked", event)
+                return
+
+            yield "retry: 5000\n" + sse("session", {"valid": True, "session_id": session_id})
+            while True:
+                until_expiry = state.expires - time.time()
+                done, _ = await asyncio.wait({future}, timeout=max(min(self.heartbeat, until_expiry), 0))
+                if done:
+                    event = future.result()
+                    if event is not None:
+                        yield sse("revoked", event)
+                    return
+                if until_expiry <= self.heartbeat:
+                    yield sse("revoked", {"valid": False, "reason": "session_expired"})
+                    return
+                yield ": ping\n\n"
+        finally:
+            self.unsubscribe(session_id, future)
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+
+    def stop(self):
+        # end every open stream so shutdown doesn't wait on them
+        for session_id in list(self._streams):
+            for future in self._streams.pop(session_id):
+                if not future.done():
+                    future.set_result(None)
+        self._loop = None
+
+    def stats(self):
+        return {"sessions": len(self._streams), "streams": len(self), "revoked": self.revoked}
@@ -16,6 +16,13 @@ class ForceLogoutRequest(BaseModel):
     logout_device_ip: str
     device_name: str
     device_info: str
+
+class BulkForceLogoutRequest(BaseModel):
+    device_ips: list[str] = []
+    session_ids: list[str] = []
+    user_emails: list[str] = []
+    device_name: str
+    device_info: str
     
 class CheckSessionRequest(BaseModel):
     login_id: str
@@ -0,0 +1,334 @@
+import logging
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from operator import attrgetter
+
+from sqlalchemy import delete, insert, select
+
+from .background import PeriodicTask
+from .cache import TTLCache
+from .database.database import SessionLocal
+from .database.models import SessionInvalidation, UserSession
+
+log = logging.getLogger(__name__)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(value: datetime):
+    """Naive UTC datetime -> epoch seconds."""
+    return None if value is None else int((value - EPOCH).total_seconds())
+
+
+def from_epoch(value: int):
+    return None if value is None else EPOCH + timedelta(seconds=value)
+
+
+def pack_id(session_id: str):
+    """16-byte form of a uuid session id; anything else is kept as it is."""
+    if len(session_id) == 36:
+        try:
+            packed = bytes.fromhex(session_id.replace("-", ""))
+        except ValueError:
+            return session_id
+        # only if it round-trips exactly (dashes in the right places, lowercase)
+        if len(packed) == 16 and unpack_id(packed) == session_id:
+            return packed
+    return session_id
+
+
+def unpack_id(key) -> str:
+    if isinstance(key, bytes):
+        h = key.hex()
+        return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+    return key
+
+
+def _intern(value):
+    return None if value is None else sys.intern(value)
+
+
+class SessionRecord:
+    """
+    The fields session validation and get_current_user need, compactly.
+
+    - 16-byte session id, interned user id / email / closed reason (shared
+      by all sessions of a user), epoch-second ints instead of datetimes
+    - force-logout details only take space on force-logged-out sessions
+    - reads like the state dict it replaces: record["expires_at"] is still a
+      datetime, record["session_id"] a str; hot paths use the attributes and
+      skip the conversions
+    """
+
+    __slots__ = ("sid", "user_id", "user_email", "is_active", "expires",
+                 "closed_reason", "access_token_exp", "force")
+
+    def __init__(self, sid, user_id, user_email, is_active, expires,
+                 closed_reason=None, access_token_exp=None, force=None):
+        self.sid = sid
+        self.user_id = user_id
+        self.user_email = user_email
+        self.is_active = is_active
+        self.expires = expires
+        self.closed_reason = closed_reason
+        self.access_token_exp = access_token_exp
+        # (force_logged_by, force_logged_at epoch, force_logout_message) or None
+        self.force = force
+
+    @classmethod
+    def from_session(cls, session: UserSession):
+        force = None
+        if session.force_logged_at is not None:
+            force = (session.force_logged_by, to_epoch(session.force_logged_at),
+                     session.force_logout_message)
+        return cls(
+            pack_id(session.session_id),
+            _intern(session.user_id),
+            _intern(session.user_email),
+            bool(session.is_active),
+            to_epoch(session.expires_at),
+            _intern(session.closed_reason),
+            session.access_token_exp,
+            force,
+        )
+
+    def to_session(self) -> UserSession:
+        """A transient UserSession with just the fields this record keeps."""
+        return UserSession(**self.as_dict())
+
+    def as_dict(self) -> dict:
+        return {key: self[key] for key in _FIELDS}
+
+    def __getitem__(self, key):
+        return _FIELDS[key](self)
+
+    def __setitem__(self, key, value):
+        # only backfills happen in place
+        if key != "access_token_exp":
+            raise TypeError(f"{key} is read-only, invalidate the session instead")
+        self.access_token_exp = value
+
+    def __repr__(self):
+        return f"SessionRecord({self.as_dict()!r})"
+
+
+_FIELDS = {
+    "session_id": lambda r: unpack_id(r.sid),
+    "user_id": attrgetter("user_id"),
+    "user_email": attrgetter("user_email"),
+    "is_active": attrgetter("is_active"),
+    "expires_at": lambda r: from_epoch(r.expires),
+    "closed_reason": attrgetter("closed_reason"),
+    "force_logged_by": lambda r: r.force[0] if r.force else None,
+    "force_logged_at": lambda r: from_epoch(r.force[1]) if r.force else None,
+    "force_logout_message": lambda r: r.force[2] if r.force else None,
+    "access_token_exp": attrgetter("access_token_exp"),
+}
+
+
+def session_state(session: UserSession) -> SessionRecord:
+    return SessionRecord.from_session(session)
+
+
+class InvalidationChannel:
+    """Fans session invalidations out to subscribers in this process."""
+
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def _notify(self, session_ids):
+        for callback in self._subscribers:
+            try:
+                callback(session_ids)
+            except Exception:
+                log.exception("invalidation subscriber failed")
+
+    def publish(self, session_ids):
+        self._notify(session_ids)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class DatabaseInvalidationChannel(InvalidationChannel):
+    """
+    Cross-worker (and cross-node) channel on the session_invalidations table.
+    Every worker polls for rows it has not seen yet, so an invalidation
+    reaches all workers within `poll_interval` seconds.
+
+    Rows are read back `grace` seconds past the previous poll rather than by
+    id alone: on a server database ids can commit out of order, and nodes'
+    clocks drift a little.
+    """
+
+    def __init__(self, poll_interval=1.0, retention=300, grace=5.0, session_factory=SessionLocal):
+        super().__init__()
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.grace = grace
+        self.session_factory = session_factory
+        self.origin = uuid.uuid4().hex
+        self._since = None
+        # id -> created_at of rows already delivered within the grace window
+        self._seen = {}
+        self._poller = PeriodicTask(self.poll, poll_interval, name="session-invalidation-poll")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-invalidation-publish")
+
+    def _write(self, session_ids, now):
+        try:
+            with self.session_factory() as db:
+                db.execute(insert(SessionInvalidation),
+                           [{"session_id": sid, "origin": self.origin, "created_at": now}
+                            for sid in session_ids])
+                db.commit()
+        except Exception:
+            log.exception("publishing session invalidations failed")
+
+    def publish(self, session_ids):
+        session_ids = list(session_ids)
+        if not session_ids:
+            return
+        self._notify(session_ids)
+        # written off the caller's thread: publish runs inside request handlers,
+        # sometimes on the event loop, and must not wait on a database lock there
+        self._writer.submit(self._write, session_ids, time.time())
+
+    def poll(self):
+        now = time.time()
+        if self._since is None:
+            # start from now, older rows predate our cache
+            self._since = now
+            return
+
+        with self.session_factory() as db:
+            rows = db.execute(
+                select(SessionInvalidation.id, SessionInvalidation.session_id,
+                       SessionInvalidation.origin, SessionInvalidation.created_at)
+                .where(SessionInvalidation.created_at > self._since - self.grace)
+                .order_by(SessionInvalidation.id)
+            ).all()
+
+            db.execute(delete(SessionInvalidation)
+                       .where(SessionInvalidation.created_at < now - self.retention))
+            db.commit()
+
+        self._since = now
+        new_rows = [row for row in rows if row.id not in self._seen]
+        for row in new_rows:
+            self._seen[row.id] = row.created_at
+        self._seen = {id_: created for id_, created in self._seen.items()
+                      if created > now - 2 * self.grace - self.poll_interval}
+
+        # our own invalidations were already delivered by publish
+        session_ids = [row.session_id for row in new_rows if row.origin != self.origin]
+        if session_ids:
+            self._notify(session_ids)
+
+    def start(self):
+        self.poll()
+        self._poller.start()
+
+    def stop(self):
+        self._poller.stop()
+
+
+class SessionCache:
+    """
+    session_id -> SessionRecord, read through from user_sessions.
+    Keys are packed to 16 bytes like the records' ids.
+    Writers call `invalidate` (or `put` for write-through) after committing;
+    invalidations are published on the channel so other workers drop
+    their copies too.
+    Every drop bumps a generation and leaves a tombstone with it, so a read
+    that started before the drop doesn't put the row it read back in; past
+    `max_tombstones` the oldest are forgotten and reads older than them
+    aren't cached either.
+    """
+
+    def __init__(self, channel: InvalidationChannel, maxsize=100000, ttl=60, max_tombstones=10000):
+        self.channel = channel
+        self.max_tombstones = max_tombstones
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._generation = 0
+        self._forgotten = 0
+        self._dropped = OrderedDict()
+        self._lock = threading.Lock()
+        self.stale_skipped = 0
+        channel.subscribe(self._drop)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _drop(self, session_ids):
+        with self._lock:
+            for session_id in session_ids:
+                key = pack_id(session_id)
+                self._generation += 1
+                self._dropped[key] = self._generation
+                self._dropped.move_to_end(key)
+                self._cache.pop(key)
+            while len(self._dropped) > self.max_tombstones:
+                _, self._forgotten = self._dropped.popitem(last=False)
+
+    def _fill(self, state: SessionRecord, generation):
+        """Cache a row read at `generation`, unless it was invalidated since."""
+        with self._lock:
+            if generation < self._forgotten or self._dropped.get(state.sid, 0) > generation:
+                self.stale_skipped += 1
+                return state
+            self._cache.set(state.sid, state)
+        return state
+
+    def get(self, session_id):
+        return self._cache.get(pack_id(session_id))
+
+    def put(self, session_id, state: SessionRecord):
+        self._cache.set(state.sid, state)
+        return state
+
+    def load(self, db, session_id):
+        state = self.get(session_id)
+        if state is None:
+            generation = self._generation
+            session = db.get(UserSession, session_id)
+            if session is None:
+                return None
+            state = self._fill(session_state(session), generation)
+        return state
+
+    async def load_async(self, db, session_id):
+        state = self.get(session_id)
+        if state is None:
+            generation = self._generation
+            session = await db.get(UserSession, session_id)
+            if session is None:
+                return None
+            state = self._fill(session_state(session), generation)
+        return state
+
+    def invalidate(self, *session_ids):
+        self._drop(session_ids)
+        self.channel.publish(session_ids)
+
+    def stats(self):
+        return {**self._cache.stats(), "stale_skipped": self.stale_skipped}
+
+
+def create_invalidation_channel(config) -> InvalidationChannel:
+    if config.SESSION_INVALIDATION_BACKEND == "database":
+        return DatabaseInvalidationChannel(poll_interval=config.SESSION_INVALIDATION_POLL_INTERVAL)
+    if config.SESSION_INVALIDATION_BACKEND == "local":
+        return InvalidationChannel()
+    raise ValueError(f"Unknown SESSION_INVALIDATION_BACKEND {config.SESSION_INVALIDATION_BACKEND!r}")
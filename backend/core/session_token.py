@@ -0,0 +1,145 @@
+"""
+Signed session tokens (SESSION_TOKEN_MODE=signed).
+
+The session_id cookie carries session_id, user_id and a short expiry,
+HMAC-signed, so a fresh token is trusted without a user_sessions lookup.
+Tokens of revoked sessions are caught by RevocationList; those and tokens
+close to expiry go through the database and get re-issued.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import math
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from .database.database import SessionLocal
+from .database.models import UserSession
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class SessionTokens:
+    """`<payload>.<signature>`, both base64url; payload is compact JSON."""
+
+    def __init__(self, secret: str, ttl=300, refresh_window=60):
+        if not secret:
+            # a random one would break tokens across restarts and workers
+            raise ValueError("SESSION_TOKEN_MODE=signed needs SESSION_TOKEN_SECRET")
+        self._key = secret.encode()
+        self.ttl = ttl
+        self.refresh_window = refresh_window
+
+    def _sign(self, payload: bytes) -> str:
+        return _b64encode(hmac.new(self._key, payload, hashlib.sha256).digest())
+
+    def issue(self, session_id, user_id, session_expires_at: datetime, now=None) -> str:
+        now = now or time.time()
+        # never outlives the session itself
+        exp = min(int(now + self.ttl), int((session_expires_at - datetime(1970, 1, 1)).total_seconds()))
+        payload = _b64encode(json.dumps(
+            {"sid": session_id, "uid": user_id, "exp": exp},
+            separators=(",", ":")).encode())
+        return f"{payload}.{self._sign(payload.encode())}"
+
+    def verify(self, token: str):
+        """Claims of a genuine token, expired or not; None for anything else."""
+        payload, _, signature = token.partition(".")
+        if not signature or not hmac.compare_digest(signature, self._sign(payload.encode())):
+            return None
+        try:
+            return json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+
+    def fresh(self, claims, now=None) -> bool:
+        return claims["exp"] - (now or time.time()) > self.refresh_window
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # double hashing: k positions from one 128-bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class RevocationList:
+    """
+    Session ids whose tokens need a database check.
+
+    - a bloom filter of sessions closed within `window` (older ones can't have
+      a live token), rebuilt from the database by sync()
+    - the exact set of ids invalidated since the last rebuild, fed by the
+      invalidation channel, so local and cross-worker logouts apply before
+      the next rebuild
+    - false positives only cost the database lookup that every request used
+      to make
+    """
+
+    def __init__(self, window: timedelta, error_rate=0.01, session_factory=SessionLocal):
+        self.window = window
+        self.error_rate = error_rate
+        self.session_factory = session_factory
+        # None until the first sync: everything needs a check
+        self._bloom = None
+        self._recent = set()
+        # ids from before the rebuild in progress; kept until the new filter is in place
+        self._previous = set()
+        self.closed = 0
+
+    def add(self, session_ids):
+        self._recent.update(session_ids)
+
+    def __contains__(self, session_id):
+        bloom = self._bloom
+        return (bloom is None or session_id in bloom
+                or session_id in self._recent or session_id in self._previous)
+
+    def sync(self):
+        self._previous, self._recent = self._recent, set()
+        db = self.session_factory()
+        try:
+            closed = db.scalars(
+                select(UserSession.session_id)
+                .where(UserSession.is_active == False,
+                       UserSession.closed_at >= datetime.utcnow() - self.window)
+            ).all()
+        except Exception:
+            self._recent |= self._previous
+            self._previous = set()
+            raise
+        finally:
+            db.close()
+        bloom = BloomFilter(len(closed), self.error_rate)
+        for session_id in closed:
+            bloom.add(session_id)
+        self._bloom = bloom
+        self._previous = set()
+        self.closed = len(closed)
+
+    def stats(self):
+        return {"closed": self.closed, "recent": len(self._recent)}
@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import DateTime, and_, delete, literal, or_, select, update
+
+from .background import PeriodicTask
+from .database.database import SessionLocal
+from .database.models import ArchivedUserSession, SessionColumns, UserSession
+
+SESSION_COLUMNS = [name for name, value in vars(SessionColumns).items()
+                   if not name.startswith("_")]
+TOKEN_COLUMNS = ("access_token", "refresh_token")
+
+
+def _insert(bind):
+    if bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+class SessionSweeper:
+    """
+    Keeps user_sessions proportional to the active sessions.
+    - expire: active sessions past expires_at are closed as "expired"
+    - archive: sessions closed more than `archive_after` ago move to
+      user_sessions_archive
+    - purge: archived rows older than `retention` are deleted (None keeps them)
+    Every step works in batches of `batch_size`, at most `max_batches` per run,
+    so a sweep never holds the write lock for long.
+    """
+
+    def __init__(self, on_expired=None, interval=60, batch_size=1000, max_batches=10,
+                 archive_after=timedelta(days=7), retention=timedelta(days=365),
+                 session_factory=SessionLocal):
+        self.on_expired = on_expired
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.archive_after = archive_after
+        self.retention = retention
+        self.session_factory = session_factory
+        self.expired = 0
+        self.archived = 0
+        self.purged = 0
+        self._task = PeriodicTask(self.sweep, interval, name="session-sweeper")
+
+    def _batches(self, step):
+        total = 0
+        for _ in range(self.max_batches):
+            count = step()
+            total += count
+            if count < self.batch_size:
+                break
+        return total
+
+    def expire_batch(self):
+        now = datetime.utcnow()
+        batch = (select(UserSession.session_id)
+                 .where(UserSession.is_active == True, UserSession.expires_at <= now)
+                 .limit(self.batch_size))
+        with self.session_factory() as db:
+            session_ids = db.execute(
+                update(UserSession)
+                .where(UserSession.session_id.in_(batch))
+                .values(is_active=False, closed_at=now, closed_reason="expired")
+                .returning(UserSession.session_id)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+            db.commit()
+
+        if session_ids and self.on_expired:
+            self.on_expired(session_ids)
+        return len(session_ids)
+
+    def archive_batch(self):
+        now = datetime.utcnow()
+        cutoff = now - self.archive_after
+        with self.session_factory() as db:
+            session_ids = db.execute(
+                select(UserSession.session_id)
+                .where(UserSession.is_active == False,
+                       or_(UserSession.closed_at < cutoff,
+                           and_(UserSession.closed_at == None, UserSession.expires_at < cutoff)))
+                .limit(self.batch_size)
+            ).scalars().all()
+            if not session_ids:
+                return 0
+
+            # closed sessions need no IdP tokens, so they aren't kept for the retention period
+            columns = [literal(None) if name in TOKEN_COLUMNS else getattr(UserSession, name)
+                       for name in SESSION_COLUMNS]
+            archive = _insert(db.get_bind())(ArchivedUserSession).from_select(
+                SESSION_COLUMNS + ["archived_at"],
+                select(*columns, literal(now, DateTime)).where(UserSession.session_id.in_(session_ids)),
+            )
+            # an id can already be archived, e.g. after an import brought it back
+            db.execute(archive.on_conflict_do_nothing(index_elements=["session_id"]))
+            db.execute(delete(UserSession).where(UserSession.session_id.in_(session_ids)))
+            db.commit()
+        return len(session_ids)
+
+    def purge_batch(self):
+        cutoff = datetime.utcnow() - self.retention
+        batch = (select(ArchivedUserSession.session_id)
+                 .where(ArchivedUserSession.archived_at < cutoff)
+                 .limit(self.batch_size))
+        with self.session_factory() as db:
+            purged = db.execute(
+                delete(ArchivedUserSession).where(ArchivedUserSession.session_id.in_(batch))
+            ).rowcount
+            db.commit()
+        return purged
+
+    def sweep(self):
+        self.expired += self._batches(self.expire_batch)
+        self.archived += self._batches(self.archive_batch)
+        if self.retention is not None:
+            self.purged += self._batches(self.purge_batch)
+
+    def start(self):
+        self._task.start()
+
+    def stop(self):
+        self._task.stop()
+
+    def stats(self):
+        return {"expired": self.expired, "archived": self.archived, "purged": self.purged}
@@ -0,0 +1,131 @@
+"""
+At-rest encryption of the IdP tokens in user_sessions and pending_logins
+(TOKEN_ENCRYPTION_KEYS).
+
+Stored values are `enc:<key id>:<base64(nonce | ciphertext | tag)>`,
+AES-256-GCM with the column name as associated data, so an access token
+can't be passed off as a refresh token. Keys:
+- TOKEN_ENCRYPTION_KEYS="k2:<secret>,k1:<old secret>", the first one
+  encrypts, the others only decrypt
+- each secret goes through HKDF-SHA256 once, when the cipher is built; a
+  request only pays for the AES-GCM call itself
+- values without the `enc:` prefix are plaintext from before encryption was
+  turned on and are read as they are; TokenRotation rewrites them, and
+  values under older key ids, with the first key in the background
+"""
+import binascii
+import logging
+import os
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from sqlalchemy import String, Text
+from sqlalchemy.types import TypeDecorator
+
+from .config import Config
+
+log = logging.getLogger(__name__)
+
+PREFIX = "enc:"
+NONCE_SIZE = 12
+
+
+def derive_key(secret: str, key_id: str) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=b"n-auth token encryption " + key_id.encode()).derive(secret.encode())
+
+
+def parse_keys(value: str) -> list[tuple[str, str]]:
+    """[(key id, secret), ...] from "kid:secret,kid:secret"."""
+    keys = []
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        key_id, sep, secret = item.partition(":")
+        if not sep or not key_id or not secret:
+            raise ValueError("TOKEN_ENCRYPTION_KEYS entries look like <key id>:<secret>")
+        keys.append((key_id, secret))
+    return keys
+
+
+class TokenCipher:
+    def __init__(self, keys: list[tuple[str, str]]):
+        if not keys:
+            raise ValueError("TokenCipher needs at least one key")
+        # derived once; AESGCM objects are reused for every call
+        self._aead = {key_id: AESGCM(derive_key(secret, key_id)) for key_id, secret in keys}
+        self.key_id = keys[0][0]
+        self.prefix = f"{PREFIX}{self.key_id}:"
+        self.failures = 0
+
+    def encrypt(self, value: str, aad: bytes) -> str:
+        nonce = os.urandom(NONCE_SIZE)
+        sealed = self._aead[self.key_id].encrypt(nonce, value.encode(), aad)
+        return self.prefix + binascii.b2a_base64(nonce + sealed, newline=False).decode()
+
+    def decrypt(self, value: str, aad: bytes):
+        """Plaintext of a stored value; None if it can't be decrypted with the configured keys."""
+        if not value.startswith(PREFIX):
+            return value
+        key_id, _, data = value[len(PREFIX):].partition(":")
+        aead = self._aead.get(key_id)
+        try:
+            if aead is None:
+                raise KeyError(key_id)
+            data = binascii.a2b_base64(data)
+            return aead.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], aad).decode()
+        except (KeyError, ValueError, InvalidTag):
+            # the session can't refresh any more and has to log in again
+            self.failures += 1
+            log.warning("stored token can't be decrypted", extra={"key_id": key_id})
+            return None
+
+    def current(self, value: str) -> bool:
+        """True if `value` is already encrypted with the first key."""
+        return value.startswith(self.prefix)
+
+    def rotate(self, value: str, aad: bytes):
+        """`value` under the first key; None if it can't be decrypted."""
+        if self.current(value):
+            return value
+        plain = self.decrypt(value, aad)
+        return None if plain is None else self.encrypt(plain, aad)
+
+
+def create_token_cipher(config) -> TokenCipher | None:
+    keys = parse_keys(config.TOKEN_ENCRYPTION_KEYS)
+    if not keys:
+        log.warning("TOKEN_ENCRYPTION_KEYS not set, IdP tokens are stored in plaintext")
+        return None
+    return TokenCipher(keys)
+
+
+# read by EncryptedString on every bind/load, None stores plaintext
+cipher = create_token_cipher(Config())
+
+
+class EncryptedString(TypeDecorator):
+    """String column encrypted with `cipher`; `purpose` is the associated data."""
+
+    impl = String
+    cache_ok = True
+
+    def __init__(self, purpose: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.purpose = purpose
+        self._aad = purpose.encode()
+
+    def process_bind_param(self, value, dialect):
+        if value is None or cipher is None:
+            return value
+        return cipher.encrypt(value, self._aad)
+
+    def process_result_value(self, value, dialect):
+        if value is None or cipher is None:
+            return value
+        return cipher.decrypt(value, self._aad)
+
+
+class EncryptedText(EncryptedString):
+    impl = Text
+    cache_ok = True
@@ -0,0 +1,91 @@
+from sqlalchemy import String, bindparam, or_, select, type_coerce, update
+
+from . import token_cipher
+from .background import PeriodicTask
+from .database.database import SessionLocal
+from .database.models import ArchivedUserSession, UserSession
+
+TOKEN_COLUMNS = ("access_token", "refresh_token")
+
+
+class TokenRotation:
+    """
+    Rewrites stored tokens that aren't under the current key (plaintext rows
+    or older key ids) in user_sessions and user_sessions_archive.
+    - batches of `batch_size` rows, at most `max_batches` per table per run
+    - a row is only written if its tokens didn't change meanwhile (e.g. a
+      refresh), so a newer token is never replaced by an older one
+    - rows that can't be decrypted are left alone and counted in `failed`
+    Once a full pass finds nothing, the old key can leave TOKEN_ENCRYPTION_KEYS.
+    """
+
+    def __init__(self, interval=60, batch_size=500, max_batches=10, session_factory=SessionLocal):
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.session_factory = session_factory
+        self.rotated = 0
+        self.failed = 0
+        self._after = {}
+        self._task = PeriodicTask(self.rotate, interval, name="token-rotation")
+
+    def _raw(self, table):
+        # the stored text, without going through EncryptedString
+        return {name: type_coerce(table.c[name], String) for name in TOKEN_COLUMNS}
+
+    def rotate_batch(self, model):
+        """Rotates one batch of `model`'s rows; returns the rows scanned."""
+        cipher = token_cipher.cipher
+        table = model.__table__
+        raw = self._raw(table)
+        stale = or_(*(column.isnot(None) & ~column.startswith(cipher.prefix) for column in raw.values()))
+        query = (select(table.c.session_id, *raw.values())
+                 .where(stale)
+                 .order_by(table.c.session_id)
+                 .limit(self.batch_size))
+        after = self._after.get(table.name)
+        if after is not None:
+            query = query.where(table.c.session_id > after)
+
+        with self.session_factory() as db:
+            rows = db.execute(query).all()
+            # next run starts after this batch, from the top once the end is reached
+            self._after[table.name] = rows[-1].session_id if len(rows) == self.batch_size else None
+
+            params = []
+            for session_id, *values in rows:
+                old = dict(zip(TOKEN_COLUMNS, values))
+                new = {name: cipher.rotate(value, name.encode())
+                       for name, value in old.items() if value is not None}
+                if None in new.values():
+                    self.failed += 1
+                    continue
+                params.append({"sid": session_id,
+                               **{f"old_{name}": old[name] for name in TOKEN_COLUMNS},
+                               **{f"new_{name}": new.get(name) for name in TOKEN_COLUMNS}})
+            if params:
+                stmt = (update(table)
+                        .where(table.c.session_id == bindparam("sid"),
+                               *(raw[name].is_not_distinct_from(bindparam(f"old_{name}", type_=String))
+                                 for name in TOKEN_COLUMNS))
+                        .values({table.c[name]: bindparam(f"new_{name}", type_=String)
+                                 for name in TOKEN_COLUMNS}))
+                self.rotated += db.execute(stmt, params).rowcount
+                db.commit()
+        return len(rows)
+
+    def rotate(self):
+        if token_cipher.cipher is None:
+            return
+        for model in (UserSession, ArchivedUserSession):
+            for _ in range(self.max_batches):
+                if self.rotate_batch(model) < self.batch_size:
+                    break
+
+    def start(self):
+        self._task.start()
+
+    def stop(self):
+        self._task.stop()
+
+    def stats(self):
+        return {"rotated": self.rotated, "failed": self.failed}
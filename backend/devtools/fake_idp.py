@@ -0,0 +1,154 @@
+"""
+Local stand-in for the identity provider: authorize, token and JWKS
+endpoints issuing RS256 tokens, for tests and benchmarks.
+
+    hypercorn devtools.fake_idp:app --bind 127.0.0.1:9000
+    IDP_BASE_URL=http://127.0.0.1:9000 hypercorn main:app
+
+FAKE_IDP_ACCESS_TTL sets the access token lifetime in seconds and
+FAKE_IDP_LATENCY_MS delays every token response.
+"""
+import asyncio
+import os
+import time
+import uuid
+from urllib.parse import parse_qsl, urlencode
+
+import rsa
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import RedirectResponse
+from jose import jwk, jwt
+
+from core.config import Config
+
+config = Config()
+
+
+class FakeIdP:
+    def __init__(self, issuer, audience, access_ttl=3600, latency=0.0, kid="fake-idp-key"):
+        self.issuer = issuer
+        self.audience = audience
+        self.access_ttl = access_ttl
+        self.latency = latency
+        self.kid = kid
+
+        public_key, private_key = rsa.newkeys(2048)
+        self.private_pem = private_key.save_pkcs1().decode()
+        self.public_jwk = jwk.construct(public_key.save_pkcs1().decode(), "RS256").to_dict()
+        self.public_jwk.update(kid=kid, use="sig", alg="RS256")
+
+        self.codes = {}
+        self.refresh_tokens = {}
+        self.calls = {"authorization_code": 0, "refresh_token": 0, "jwks": 0}
+
+    def jwks(self):
+        return {"keys": [self.public_jwk]}
+
+    def _sign(self, claims):
+        return jwt.encode(claims, self.private_pem, algorithm="RS256", headers={"kid": self.kid})
+
+    def access_token(self, sub, permissions=(), ttl=None):
+        now = int(time.time())
+        return self._sign({
+            "iss": self.issuer,
+            "sub": sub,
+            "aud": self.audience,
+            "iat": now,
+            "exp": now + (self.access_ttl if ttl is None else ttl),
+            "permissions": list(permissions),
+        })
+
+    def issue_code(self, email, permissions=(), presign=False):
+        """presign=True signs the tokens now so the exchange itself is cheap."""
+        code = uuid.uuid4().hex
+        user = {"email": email, "permissions": list(permissions)}
+        if presign:
+            user["tokens"] = self._tokens(user, uuid.uuid4().hex)
+        self.codes[code] = user
+        return code
+
+    def _tokens(self, user, refresh_token):
+        sub = f"fake|{user['email']}"
+        now = int(time.time())
+        return {
+            "access_token": self.access_token(sub, user["permissions"]),
+            "id_token": self._sign({
+                "iss": self.issuer, "sub": sub, "aud": config.CLIENT_ID,
+                "iat": now, "exp": now + self.access_ttl,
+                "email": user["email"], "name": user["email"].split("@")[0],
+            }),
+            "refresh_token": refresh_token,
+            "token_type": "Bearer",
+            "expires_in": self.access_ttl,
+        }
+
+    def exchange_code(self, code):
+        self.calls["authorization_code"] += 1
+        user = self.codes.pop(code, None)
+        if user is None:
+            return None
+        tokens = user.pop("tokens", None) or self._tokens(user, uuid.uuid4().hex)
+        self.refresh_tokens[tokens["refresh_token"]] = user
+        return tokens
+
+    def refresh(self, refresh_token):
+        self.calls["refresh_token"] += 1
+        user = self.refresh_tokens.get(refresh_token)
+        if user is None:
+            return None
+        return self._tokens(user, refresh_token)
+
+
+idp = FakeIdP(
+    issuer=f"https://{config.DOMAIN}/",
+    audience=config.API_AUDIENCE,
+    access_ttl=int(os.getenv("FAKE_IDP_ACCESS_TTL", 3600)),
+    latency=float(os.getenv("FAKE_IDP_LATENCY_MS", 0)) / 1000,
+)
+
+app = FastAPI()
+
+
+@app.get("/.well-known/jwks.json")
+def jwks():
+    idp.calls["jwks"] += 1
+    return idp.jwks()
+
+
+@app.get("/authorize")
+def authorize(redirect_uri: str, login_hint: str = "user@example.com", state: str | None = None):
+    params = {"code": idp.issue_code(login_hint)}
+    if state:
+        params["state"] = state
+    return RedirectResponse(f"{redirect_uri}?{urlencode(params)}")
+
+
+@app.post("/oauth/token")
+async def token(request: Request):
+    # form-encoded body, parsed by hand to avoid a python-multipart dependency
+    form = dict(parse_qsl((await request.body()).decode()))
+    if idp.latency:
+        await asyncio.sleep(idp.latency)
+
+    grant_type = form.get("grant_type")
+    if grant_type == "authorization_code":
+        tokens = idp.exchange_code(form.get("code"))
+    elif grant_type == "refresh_token":
+        tokens = idp.refresh(form.get("refresh_token"))
+    else:
+        raise HTTPException(status_code=400, detail="unsupported_grant_type")
+
+    if tokens is None:
+        raise HTTPException(status_code=403, detail="invalid_grant")
+    return tokens
+
+
+@app.post("/test/code")
+def test_code(email: str, permissions: str = ""):
+    """Mint an authorization code directly, skipping the browser redirect."""
+    return {"code": idp.issue_code(email, [p for p in permissions.split(",") if p])}
+
+
+@app.get("/test/stats")
+def stats():
+    return idp.calls
@@ -0,0 +1,132 @@
+"""
+Scriptable identity provider stub on a real socket, for exercising the
+outbound client: keep-alive, timeouts, retries and the circuit breaker.
+Standard library only, runs on a background thread.
+
+    with StubIdP() as stub:
+        stub.script(503, 503)      # next two token calls fail
+        stub.delay = 2.0           # every call sleeps first
+        os.environ["IDP_BASE_URL"] = stub.url
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    # headers and body go out as separate writes; without this delayed ACKs add ~40ms per call
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, body):
+        stub = self.server.stub
+        stub._enter(self.client_address)
+        try:
+            if stub.delay:
+                time.sleep(stub.delay)
+            status = stub._next_status()
+            if status != 200:
+                return self._reply(status, {"error": "scripted"})
+            self._reply(200, body)
+        finally:
+            stub._leave()
+
+    def do_GET(self):
+        if self.path.startswith("/.well-known/jwks.json"):
+            return self._handle({"keys": []})
+        self._reply(404, {"error": "not_found"})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/oauth/token"):
+            return self._handle({"access_token": "stub", "refresh_token": "stub",
+                                 "token_type": "Bearer", "expires_in": 3600})
+        self._reply(404, {"error": "not_found"})
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that time out hang up mid-response, that's the point
+        pass
+
+
+class StubIdP:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.delay = 0.0
+        self.calls = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.connections = set()
+        self._statuses = []
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def script(self, *statuses):
+        """Status codes for the next calls, then 200 again."""
+        with self._lock:
+            self._statuses = list(statuses)
+
+    def reset(self):
+        with self._lock:
+            self.delay = 0.0
+            self.calls = 0
+            self.max_inflight = 0
+            self.connections.clear()
+            self._statuses = []
+
+    def wait_idle(self, timeout=10):
+        """Until calls still sleeping on an old `delay` are done."""
+        deadline = time.monotonic() + timeout
+        while self.inflight and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _next_status(self):
+        with self._lock:
+            return self._statuses.pop(0) if self._statuses else 200
+
+    def _enter(self, client_address):
+        with self._lock:
+            self.calls += 1
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+            self.connections.add(client_address)
+
+    def _leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-idp", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,25 +1,82 @@
+import logging
 import os 
+import time
 import uuid 
 import json 
 import jwt
-import requests
 from fastapi import Body, FastAPI, status
 from typing import Annotated, Optional
 from fastapi import Depends, HTTPException, Response, Request
-from fastapi.responses import RedirectResponse, JSONResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 
 #in-code modules
 from core.config import Config
-from core.schemas import ForceLogoutRequest, LoginRequest, SessionResponse, UserClaims
-from core.auth import get_current_user, process_login_token, validate_token, check_session, logout_session, forced_logout
-from core.database.database import Base , engine, get_db
+from core.schemas import ForceLogoutRequest, BulkForceLogoutRequest, LoginRequest, UserClaims
+from core.auth import process_login_token_async, validate_token, jwks_store
+from core.auth import get_current_user_async, check_session_async, logout_session_async, forced_logout_async
+from core.auth import pending_reaper, session_cache, invalidation_channel, last_active_buffer, session_sweeper
+from core.auth import token_refresher, revocation_hub, revocation_sync, read_session_cookie, trusted_claims, set_session_cookie
+from core.auth import ip_limiter, rate_limit_reaper, token_rotation
+from core.auth import bulk_forced_logout_async, bulk_forced_logout_summary, require_permission
+from core.database.database import engine, get_async_db, async_engine
+from core import idp
+from core.database.migrations import upgrade
+from core.database.transfer import FORMATS, body_lines, export_sessions_async, import_sessions_async
 from core.database.models import UserSession
+from core.metrics import MetricsMiddleware, registry
+from core.log import RequestIdMiddleware, setup_logging
+from core.revocation import revocation
+from core.ratelimit import limit_by_ip
 
-app = FastAPI()
 config = Config()
+setup_logging(config)
+log = logging.getLogger(__name__)
+# sampled, see Config.LOG_SAMPLE_RATES
+validate_log = logging.getLogger("session.validate")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # shared outbound client + background jobs
+    await idp.start()
+    jwks_store.start()
+    pending_reaper.start()
+    rate_limit_reaper.start()
+    invalidation_channel.start()
+    revocation_hub.start()
+    if revocation_sync:
+        revocation_sync.start()
+    last_active_buffer.start()
+    session_sweeper.start()
+    if token_rotation:
+        token_rotation.start()
+    token_refresher.start()
+    yield
+    await token_refresher.stop()
+    if token_rotation:
+        token_rotation.stop()
+    session_sweeper.stop()
+    # flushes pending last_active updates
+    last_active_buffer.stop()
+    if revocation_sync:
+        revocation_sync.stop()
+    # ends open /session/events streams
+    revocation_hub.stop()
+    invalidation_channel.stop()
+    rate_limit_reaper.stop()
+    pending_reaper.stop()
+    jwks_store.stop()
+    await idp.close()
+    await async_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     f"{config.FRONTEND_URI}",
@@ -35,57 +92,49 @@ app.add_middleware(
     expose_headers=["*"],
     max_age=3600,
 )
+# latency includes the other middleware; the request id wraps everything so every log line has it
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestIdMiddleware)
+
+# per client ip, on routes that write sessions or call the IdP
+rate_limited = [Depends(limit_by_ip(ip_limiter))]
 
-Base.metadata.create_all(bind = engine)
+# create tables and any indexes missing from older db files
+upgrade(engine)
 
 @app.get("/")
 def root():
     return "N-auth"
 
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/login")
 def back_login():
-    print("In login")
-    return RedirectResponse(
-        "https://dev-nlex2vytg8hlk2gz.us.auth0.com/authorize"
-        "?response_type=code"
-        f"&client_id={config.CLIENT_ID}"
-        f"&redirect_uri={config.BACKEND_URI}/token"
-        "&scope=offline_access openid profile email" 
-        f"&audience={config.API_AUDIENCE}"
-    )
+    return RedirectResponse(idp.authorize_url(f"{config.BACKEND_URI}/token"))
 
-@app.get("/token")
-def get_access_token(code: str, response:Response):
-    print("In token")
-    payload = (
-        "grant_type=authorization_code"
-        f"&client_id={config.CLIENT_ID}"
-        f"&client_secret={config.CLIENT_SECRET}"
-        f"&code={code}"
-        "&scope=offline_access openid profile email"
-        f"&redirect_uri={config.BACKEND_URI}/token"
-    )
-    headers = {"content-type": "application/x-www-form-urlencoded"}
-    token_response = requests.post(
-        "https://dev-nlex2vytg8hlk2gz.us.auth0.com/oauth/token", data=payload, headers=headers).json()
+@app.get("/token", dependencies=rate_limited)
+async def get_access_token(code: str, response:Response):
+    token_response = await idp.exchange_code(code)
     
     
-    login_id, _,_ = process_login_token(token_response)
+    login_id, _,_ = await process_login_token_async(token_response)
 
-    print("Leaving token")
+    log.debug("code exchanged, login pending")
     return RedirectResponse(f"{config.FRONTEND_URI}/callback?login_id={login_id}")
     # return token_response
 
 
 @app.post("/logout")
-async def logout(request: Request, db:Session = Depends(get_db)):
-    session_id = request.cookies.get("session_id")
+async def logout(request: Request, db: AsyncSession = Depends(get_async_db)):
+    session_id, _ = read_session_cookie(request)
     if not session_id:
         return HTTPException(
             status_code= status.HTTP_401_UNAUTHORIZED,
             detail = "No session found"
         )
-    success = logout_session(session_id, db)
+    success = await logout_session_async(session_id, db)
     if success:
         response = JSONResponse({"success":True})
         response.delete_cookie(key="session_id")
@@ -96,11 +145,11 @@ async def logout(request: Request, db:Session = Depends(get_db)):
         detail = "LogoutFailed"
     )
 
-@app.post("/logout/force")
+@app.post("/logout/force", dependencies=rate_limited)
 async def force_logout(
     request: Request,
     payload: ForceLogoutRequest,  # Update parameter order
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Force logout all sessions for a specific device IP
@@ -112,7 +161,7 @@ async def force_logout(
         device_ip = request.client.host
         # print("Current device IP:", device_ip)
         
-        result = forced_logout(
+        result = await forced_logout_async(
             logout_device_ip=payload.logout_device_ip,
             device_ip=device_ip,
             device_name=payload.device_name,
@@ -139,72 +188,157 @@ async def force_logout(
         )
 
 
+@app.post("/logout/force/bulk")
+async def bulk_force_logout(
+    request: Request,
+    payload: BulkForceLogoutRequest,
+    user_claims: UserClaims = Depends(require_permission("sessions:force_logout")),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Force logout every active session matching any of the given
+    device ips, session ids or user emails
+    """
+    if not (payload.device_ips or payload.session_ids or payload.user_emails):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="No device_ips, session_ids or user_emails given")
+
+    closed = await bulk_forced_logout_async(
+        db,
+        forced_by_ip=request.client.host,
+        device_name=payload.device_name,
+        device_info=payload.device_info,
+        device_ips=payload.device_ips,
+        session_ids=payload.session_ids,
+        user_emails=payload.user_emails,
+    )
+    return JSONResponse(status_code=status.HTTP_200_OK,
+                        content=bulk_forced_logout_summary(closed))
+
+
+@app.get("/admin/sessions/export")
+async def export_sessions(
+    format: str = "rows",
+    active: Optional[bool] = None,
+    user_email: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    tokens: bool = False,
+    chunk: int = 1000,
+    user_claims: UserClaims = Depends(require_permission("sessions:export")),
+):
+    """
+    Stream user_sessions as NDJSON (see core.database.transfer), one page in memory at a time.
+    Tokens are left out unless `tokens=true`.
+    """
+    if format not in FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"format must be one of {', '.join(FORMATS)}")
+    lines = export_sessions_async(async_engine, fmt=format, chunk=min(max(chunk, 1), 10000),
+                                  active=active, user_email=user_email, since=since,
+                                  until=until, tokens=tokens)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
+@app.post("/admin/sessions/import")
+async def import_sessions(
+    request: Request,
+    replace: bool = False,
+    user_claims: UserClaims = Depends(require_permission("sessions:import")),
+):
+    """
+    NDJSON body in either export format, inserted in batches as it streams in.
+    Existing session ids are skipped, or overwritten with `replace=true`.
+    """
+    try:
+        read, written = await import_sessions_async(
+            body_lines(request), async_engine, replace=replace,
+            # replaced sessions must not be served from any worker's cache
+            on_batch=(lambda ids: session_cache.invalidate(*ids)) if replace else None,
+        )
+    except (ValueError, KeyError, TypeError, IntegrityError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Bad session line: {e}")
+    return JSONResponse(status_code=status.HTTP_200_OK, content={"read": read, "written": written})
+
 
 @app.get("/session/validate")
-def validate_session(request:Request, db: Session = Depends(get_db)):
-    print("session validation")
-    session_id = request.cookies.get("session_id")
+async def validate_session(request:Request, db: AsyncSession = Depends(get_async_db)):
+    session_id, claims = read_session_cookie(request)
     # print(session_id)
     if not session_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="No session cookie")
-    
-    session = db.query(UserSession).filter_by(
-        session_id=session_id
-    ).first()
 
-    if not session:
-        return JSONResponse(status_code = status.HTTP_200_OK,
-                            content={"valid":False, "reason":"session_not_found"})
+    if trusted_claims(claims):
+        # signed, fresh and not revoked: no database
+        last_active_buffer.touch(session_id, datetime.utcnow())
+        return JSONResponse(status_code=status.HTTP_200_OK,
+                            content={"valid": True, "session_id": session_id, "user_id": claims["uid"]})
     
-    # print(session)
+    session = await session_cache.load_async(db, session_id)
     now = datetime.utcnow()
-    print(session.is_active, session.closed_reason, session.expires_at, now)
+    revoked = revocation(session, time.time())
 
-    if not session.is_active and session.closed_reason == "force_logout":
-        return JSONResponse(
-            status_code=status.HTTP_200_OK,
-            content={
-                "valid": False,
-                "reason": "force_logged_out",
-                "details": {
-                    "logged_out_by": session.force_logged_by,
-                    "logged_out_at": session.force_logged_at.isoformat(),
-                    "message": session.force_logout_message
-                }
-            }
-        )
-    
-    print("surpassed force logout check")
-    
-    if not session.is_active or session.expires_at <= now:
-        session.is_active = False
-        request.delete_cookie(key="session_id")
-        db.commit()
-        return JSONResponse(
-            status_code=status.HTTP_200_OK,
-            content={"valid": False, "reason": "session_expired"}
-        )
+    if revoked and revoked["reason"] == "session_expired":
+        if session["is_active"]:
+            await db.execute(
+                update(UserSession)
+                .where(UserSession.session_id == session_id)
+                .values(is_active=False, closed_at=now, closed_reason="expired")
+            )
+            await db.commit()
+            session_cache.invalidate(session_id)
+        validate_log.info("session invalid", extra={"reason": "session_expired"})
+        response = JSONResponse(status_code=status.HTTP_200_OK, content=revoked)
+        response.delete_cookie(key="session_id")
+        return response
+
+    if revoked:
+        if session:
+            validate_log.info("session invalid", extra={"reason": revoked["reason"]})
+        return JSONResponse(status_code=status.HTTP_200_OK, content=revoked)
     
-    session.last_active = now
-    db.commit()
-    print("Sesssion validation out")
-    return JSONResponse(
+    last_active_buffer.touch(session_id, now)
+    validate_log.debug("session valid", extra={"user_id": session["user_id"]})
+    response = JSONResponse(
         status_code=status.HTTP_200_OK,
         content={
             "valid": True,
-            "session_id": session.session_id,
-            "user_id": session.user_id
+            "session_id": session["session_id"],
+            "user_id": session["user_id"]
         }
     )
-@app.post("/session/check")
-def post_check_session(payload: LoginRequest, request:Request,response: Response, db: Session = Depends(get_db)):
+    if config.SESSION_TOKEN_MODE == "signed":
+        # near expiry, possibly revoked or still opaque: checked above, (re-)issue the token
+        set_session_cookie(response, session_id, session["user_id"], session["expires_at"], now)
+    return response
+
+@app.get("/session/events")
+async def session_events(request: Request):
+    """
+    Server-sent events for the session in the cookie, instead of polling /session/validate.
+    - `session` once connected, then heartbeats
+    - `revoked` (same body as an invalid /session/validate) on force logout, logout or expiry, then the stream ends
+    """
+    session_id, _ = read_session_cookie(request)
+    if not session_id:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="No session cookie")
+    return StreamingResponse(
+        revocation_hub.stream(session_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/session/check", dependencies=rate_limited)
+async def post_check_session(payload: LoginRequest, request:Request,response: Response, db: AsyncSession = Depends(get_async_db)):
     login_id = payload.login_id
     device_info = payload.device_info
     device_name = payload.device_name
     device_ip = request.client.host
 
-    check_session(login_id, device_ip, device_info, device_name,response,db)
+    await check_session_async(login_id, device_ip, device_info, device_name,response,db)
 
 @app.get("/protected")
 def protected_route(user_claims: UserClaims = Depends(validate_token)):
@@ -217,9 +351,8 @@ def protected_route(user_claims: UserClaims = Depends(validate_token)):
 
 
 @app.get("/profile")
-def get_profile(
-    current_user=Depends(get_current_user), 
-    db: Session = Depends(get_db)
+async def get_profile(
+    current_user=Depends(get_current_user_async)
 ):
     return {
         "message": "Protected route",
@@ -25,6 +25,20 @@ export const AuthProvider = ({ children }) => {
       window.location.href = loginUrl
     }
 
+    // same shape from /session/validate and the `revoked` event of /session/events
+    const applySessionState = (data) => {
+      if (data.valid) {
+        setIsAuthenticated(true)
+        setForceLogoutInfo(null)
+      } else {
+        setIsAuthenticated(false)
+        // Check if user was force logged out
+        if (data.reason === 'force_logged_out') {
+          setForceLogoutInfo(data.details)
+        }
+      }
+    }
+
     const checkAuth = async () => {
       try {
         const res = await fetch(`${AUTH_CONFIG.BACKEND_URL}/session/validate`, {
@@ -38,17 +52,7 @@ export const AuthProvider = ({ children }) => {
         
         const data = await res.json()
         console.log("Auth check:", data)
-        
-        if (data.valid) {
-          setIsAuthenticated(true)
-          setForceLogoutInfo(null)
-        } else {
-          setIsAuthenticated(false)
-          // Check if user was force logged out
-          if (data.reason === 'force_logged_out') {
-            setForceLogoutInfo(data.details)
-          }
-        }
+        applySessionState(data)
       } catch (error) {
         console.error('Auth check failed:', error)
         setIsAuthenticated(false)
@@ -61,6 +65,26 @@ export const AuthProvider = ({ children }) => {
     checkAuth()
   }, [])
 
+  // while logged in the backend pushes revocations, no polling needed
+  useEffect(() => {
+    if (!isAuthenticated) return
+
+    const events = new EventSource(`${AUTH_CONFIG.BACKEND_URL}/session/events`, {
+      withCredentials: true
+    })
+    events.addEventListener('revoked', (event) => {
+      events.close()
+      applySessionState(JSON.parse(event.data))
+    })
+    events.onerror = () => {
+      // CONNECTING means the browser is already retrying; CLOSED means it gave up (e.g. 401)
+      if (events.readyState === EventSource.CLOSED) {
+        checkAuth()
+      }
+    }
+    return () => events.close()
+  }, [isAuthenticated])
+
   const logout = async () => {
     try {
       await fetch(`${AUTH_CONFIG.BACKEND_URL}/logout`, {